@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+xl 的性能基准：解析、输出的吞吐量（MB/s）和峰值内存。
+
+    python bench_xl.py                      # 跑全部文档，打印表格
+    python bench_xl.py --json new.json      # 同时把结果写成 JSON
+    python bench_xl.py --compare old.json new.json
+"""
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+import xl
+
+
+_words = ["如是我聞", "一時", "佛", "lorem", "ipsum", "dolor", "sit", "amet", "&amp;", "&lt;", "&gt;", "&quot;",
+          "&#x4E2D;", "&#65;"]
+
+
+def _text(r, n):
+    return " ".join(r.choice(_words) for _ in range(n))
+
+
+def deep_doc(size, r):
+    # 一层套一层，每 100 层回到顶层。缩进输出的长度随层数平方增长，层数太多时 to_str_pretty 只是在测字符串拼接
+    parts = []
+    total = 0
+    while total < size:
+        depth = 100
+        chunk = "<d>" * depth + _text(r, 3) + "</d>" * depth
+        parts.append(chunk)
+        total += len(chunk)
+    return "<root>" + "".join(parts) + "</root>"
+
+
+def wide_doc(size, r):
+    parts = []
+    total = 0
+    while total < size:
+        chunk = "<i>{}</i>".format(r.randint(0, 10 ** 6))
+        parts.append(chunk)
+        total += len(chunk)
+    return "<root>" + "".join(parts) + "</root>"
+
+
+def attrs_doc(size, r):
+    parts = []
+    total = 0
+    while total < size:
+        attrs = " ".join('a{}="{}"'.format(n, r.choice(["x", "1 &lt; 2", "it&apos;s", "v" * 10]))
+                         for n in range(r.randint(3, 12)))
+        chunk = "<e {}/>".format(attrs)
+        parts.append(chunk)
+        total += len(chunk)
+    return "<root>" + "".join(parts) + "</root>"
+
+
+def text_doc(size, r):
+    parts = []
+    total = 0
+    while total < size:
+        chunk = "<p>{}</p>\n".format(_text(r, 60))
+        parts.append(chunk)
+        total += len(chunk)
+    return "<root>" + "".join(parts) + "</root>"
+
+
+def comment_doc(size, r):
+    parts = []
+    total = 0
+    while total < size:
+        chunk = "<!--CBETA todo type: {}--><n>{}</n>".format(r.choice(["a", "newmod", "note"]), _text(r, 2))
+        parts.append(chunk)
+        total += len(chunk)
+    return "<root>" + "".join(parts) + "</root>"
+
+
+def tei_doc(size, r):
+    # 模仿 CBETA 的 TEI 文件：teiHeader、带 xml:id 的 lb/pb、note、app/lem/rdg、缩进
+    head = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<?xml-model href="http://www.tei-c.org/release/xml/tei/custom/schema/relaxng/tei_all.rng"?>\n'
+            '<TEI xmlns="http://www.tei-c.org/ns/1.0" xmlns:cb="http://www.cbeta.org/ns/1.0" xml:id="T01n0001">\n'
+            '  <teiHeader>\n    <fileDesc>\n      <titleStmt><title>長阿含經</title></titleStmt>\n'
+            '    </fileDesc>\n  </teiHeader>\n  <text>\n    <body>\n')
+    parts = [head]
+    total = len(head)
+    n = 0
+    while total < size:
+        n += 1
+        chunk = ('      <p xml:id="pT01p{0:04d}a" cb:place="inline">\n'
+                 '        <lb n="{0:04d}a01" ed="T"/>{1}<note n="{0:04d}001" resp="Taisho" type="orig"'
+                 ' place="foot text">{2}</note>{3}\n'
+                 '        <lb n="{0:04d}a02" ed="T"/><app n="{0:04d}002"><lem wit="【大】">{4}</lem>'
+                 '<rdg resp="Taisho" wit="【宋】">{5}</rdg></app>{1}\n'
+                 '        <pb n="{0:04d}b" ed="T" xml:id="T01.0001.{0:04d}b"/>\n'
+                 '      </p>\n').format(n, _text(r, 8), _text(r, 2), _text(r, 5), _text(r, 1), _text(r, 1))
+        parts.append(chunk)
+        total += len(chunk)
+    parts.append("    </body>\n  </text>\n</TEI>\n")
+    return "".join(parts)
+
+
+DOCS = {
+    "deep": (deep_doc, "d"),
+    "wide": (wide_doc, "i"),
+    "attrs": (attrs_doc, "e"),
+    "text": (text_doc, "p"),
+    "comment": (comment_doc, "n"),
+    "tei": (tei_doc, "lb"),
+}
+
+
+def _operations(text, tag):
+    xml = xl.parse(text)
+    # parse_e 只接受一个元素，去掉开头的问号元素
+    element_text = text
+    while element_text.startswith("<?"):
+        element_text = element_text[element_text.index("?>") + 2:].lstrip()
+    return {
+        "parse": lambda: xl.parse(text),
+        "parse_e": lambda: xl.parse_e(element_text),
+        "to_str": lambda: xml.to_str(),
+        "to_str_pretty": lambda: xml.to_str(do_pretty=True),
+        "find_all": lambda: xml.root.find_all(tag),
+    }
+
+
+def _measure(func, repeat):
+    best = None
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - begin
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def run(size=1000000, repeat=3, docs=None, operations=None, seed=0):
+    """ 返回 [{"doc", "operation", "bytes", "seconds", "mb_per_s", "peak_bytes"}, ...] """
+    results = []
+    for name in docs or DOCS:
+        make, tag = DOCS[name]
+        text = make(size, random.Random(seed))
+        nbytes = len(text.encode("utf-8"))
+        for operation, func in _operations(text, tag).items():
+            if operations and operation not in operations:
+                continue
+            seconds, peak = _measure(func, repeat)
+            results.append({
+                "doc": name,
+                "operation": operation,
+                "bytes": nbytes,
+                "seconds": seconds,
+                "mb_per_s": nbytes / 1e6 / seconds if seconds else float("inf"),
+                "peak_bytes": peak,
+            })
+    return results
+
+
+def _print_table(results, file=sys.stdout):
+    print("{:<8} {:<14} {:>9} {:>10} {:>12}".format("doc", "operation", "MB", "MB/s", "peak MB"), file=file)
+    for r in results:
+        print("{:<8} {:<14} {:>9.2f} {:>10.2f} {:>12.2f}".format(
+            r["doc"], r["operation"], r["bytes"] / 1e6, r["mb_per_s"], r["peak_bytes"] / 1e6), file=file)
+
+
+def compare(old, new, file=sys.stdout):
+    """ 对比两次 run 的结果，打印速度和峰值内存的变化倍数 """
+    old = {(r["doc"], r["operation"]): r for r in old}
+    print("{:<8} {:<14} {:>10} {:>10} {:>8} {:>10}".format("doc", "operation", "old MB/s", "new MB/s", "speed",
+                                                        "peak mem"), file=file)
+    for r in new:
+        o = old.get((r["doc"], r["operation"]))
+        if o is None:
+            continue
+        print("{:<8} {:<14} {:>10.2f} {:>10.2f} {:>7.2f}x {:>9.2f}x".format(
+            r["doc"], r["operation"], o["mb_per_s"], r["mb_per_s"], r["mb_per_s"] / o["mb_per_s"],
+            r["peak_bytes"] / o["peak_bytes"] if o["peak_bytes"] else float("inf")), file=file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark xl parse and serialize throughput and memory.")
+    parser.add_argument("--size", type=int, default=1000000, help="approximate size of each document in characters")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the best one is kept")
+    parser.add_argument("--doc", action="append", choices=sorted(DOCS), help="only these documents")
+    parser.add_argument("--operation", action="append", help="only these operations")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)["results"]
+        with open(args.compare[1]) as f:
+            new = json.load(f)["results"]
+        compare(old, new)
+        return
+
+    results = run(args.size, args.repeat, args.doc, args.operation)
+    _print_table(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"xl_version": xl.__version__,
+                       "python": platform.python_version(),
+                       "implementation": platform.python_implementation(),
+                       "size": args.size,
+                       "results": results}, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
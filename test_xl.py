@@ -1,8 +1,16 @@
 #!/usr/bin/env python3
 
+import asyncio
+import copy
+import io
+import os
+import pickle
+import tempfile
 import unittest
 import xl
 
+import bench_xl
+
 
 _xml1_text = \
     """<?xml version="1.0" encoding="UTF-8"?>
@@ -97,5 +105,782 @@ class MytestCase3(unittest.TestCase):
         self.assertEqual(len(xml3.root.find_kids("c")), 1)
 
 
+class DeepTestCase(unittest.TestCase):
+    def test_deep(self):
+        n = 100000
+        xml = xl.parse("<d>" * n + "x" + "</d>" * n)
+        e = xml.root
+        depth = 1
+        while e.kids and isinstance(e.kids[0], xl.Element):
+            e = e.kids[0]
+            depth += 1
+        self.assertEqual(depth, n)
+        self.assertEqual(e.kids, ["x"])
+
+    def test_unclosed(self):
+        self.assertRaises(xl.ParseError, xl.parse_e, "<a><b></a>")
+
+    def test_deep_to_str(self):
+        n = 100000
+        text = "<d>" * n + "x" + "</d>" * n
+        self.assertEqual(xl.parse_e(text).to_str(), text)
+
+
+class LazyTestCase(unittest.TestCase):
+    def test_same_as_eager(self):
+        for kwargs in ({}, {"dont_do_tags": ["p"]}, {"ignore_comment": True}):
+            eager = xl.parse(_xml1_text, **kwargs)
+            lazy = xl.parse(_xml1_text, lazy=True, **kwargs)
+            self.assertEqual(lazy.to_str(do_pretty=True), eager.to_str(do_pretty=True))
+
+    def test_deferred(self):
+        xml = xl.parse("<r><a><b>1</b></a><c/> <d>x<!--y--></d></r>", lazy=True)
+        a = xml.root.kids[0]
+        self.assertIsInstance(a._kids, xl._Pending)
+        self.assertEqual(xml.root.find("a/b").kids, ["1"])
+        self.assertEqual(xml.root.kids[2].kids[0], "x")
+
+    def test_errors(self):
+        self.assertRaises(xl.ParseError, xl.parse, "<r><a></b></r>", lazy=True)
+        self.assertRaises(xl.ParseError, xl.parse, "<r><a></a>", lazy=True)
+
+
+class SlotsTestCase(unittest.TestCase):
+    def test_slots(self):
+        for node in (xl.Element("a"), xl.QMElement("a"), xl.Prolog(), xl.Comment("a"), xl.DocType()):
+            self.assertFalse(hasattr(node, "__dict__"))
+
+    def test_lazy_containers(self):
+        e = xl.parse_e('<a><b/><c x="1"></c></a>')
+        b, c = e.kids
+        self.assertIsNone(b._kids)
+        self.assertIsNone(b._attrs)
+        self.assertIsNone(c._kids)
+        self.assertEqual(b.kids, [])
+        b.kids.append("x")
+        self.assertEqual(e.to_str(), '<a><b>x</b><c x="1"/></a>')
+        self.assertRaises(ValueError, xl.Element, None)
+
+
+class EscapeTestCase(unittest.TestCase):
+    def test_unescape(self):
+        e = xl.parse_e('<a t="&#60;&#x4E2D;&quot;&apos;&unknown;">&amp;lt; &#65;&#x42; &quot;&apos; &bogus; &#0;</a>')
+        self.assertEqual(e.attrs["t"], "<中\"'&unknown;")
+        self.assertEqual(e.kids, ["&lt; AB \"' &bogus; &#0;"])
+
+    def test_round_trip(self):
+        e = xl.Element("a", {"t": "<&\"'>"}, kids=["x < y & z > w"])
+        s = e.to_str()
+        self.assertEqual(s, '<a t="&lt;&amp;&quot;&apos;&gt;">x &lt; y &amp; z &gt; w</a>')
+        self.assertEqual(xl.parse_e(s).to_str(), s)
+
+
+class IndexTestCase(unittest.TestCase):
+    def test_index(self):
+        xml = xl.parse('<r><a id="1"><b xml:id="2"/></a><b/></r>', index=True)
+        self.assertEqual(len(xml.find_all("b")), 2)
+        self.assertEqual(xml.find_id("2").tag, "b")
+
+        a = xml.find_id("1")
+        a.ekid("b", {"id": "3"})
+        self.assertEqual(len(xml.find_all("b")), 3)
+        self.assertIs(xml.find_id("3"), a.kids[-1])
+
+        a.kids[-1].attrs["id"] = "4"
+        self.assertIsNone(xml.find_id("3"))
+        self.assertIs(xml.find_id("4"), a.kids[-1])
+
+        xl.sub(a, "c")
+        self.assertEqual(len(a.find_kids("c")), 1)
+        del a.kids[:]
+        self.assertEqual(a.find_kids("c"), [])
+        self.assertEqual(len(xml.find_all("b")), 1)
+
+    def test_find_kids_after_edit(self):
+        xml = xl.parse("<r><a><b/><c/></a><d/></r>", index=True)
+        a = xml.root.kids[0]
+        self.assertEqual(len(a.find_kids("b")), 1)
+        a.kids[1].tag = "b"
+        self.assertEqual(len(a.find_kids("b")), 2)
+        xml.root.kids[1].ekid("x")
+        self.assertEqual(len(a.find_kids("b")), 2)
+        a.kids.pop(0)
+        self.assertEqual(a.find_kids("b"), [a.kids[0]])
+
+    def test_same_as_walk(self):
+        xml = xl.parse(_xml1_text)
+        tags = [e.tag for e in xml.root.find_all("a") + xml.root.find_all("p")]
+        xml.root.build_index()
+        self.assertEqual([e.tag for e in xml.root.find_all("a") + xml.root.find_all("p")], tags)
+
+    def test_held_references(self):
+        # 建立索引、跟踪父节点、缓存输出都不能换掉调用者已经拿到的 kids、attrs
+        for enable in (xl.Xml.build_index, xl.Xml.track_parents, xl.Xml.build_str_cache):
+            xml = xl.parse('<r><p n="1"/></r>')
+            top, kids, attrs = xml.kids, xml.root.kids, xml.root.kids[0].attrs
+            enable(xml)
+            kids.append(xl.Element("p"))
+            attrs["n"] = "2"
+            top.append(xl.Comment("c"))
+            self.assertIs(xml.root.kids, kids)
+            self.assertEqual(xml.root.to_str(), '<r><p n="2"/><p/></r>')
+            self.assertIs(xml.kids[-1], top[-1])
+            self.assertEqual(len(xml.find_all("p")), 2)
+
+    def test_copy_without_index(self):
+        # 复制、pickle 一个元素不会连带索引所在的整篇文档
+        xml = xl.parse(_xml1_text, index=True, parents=True)
+        p = xml.find_all("p")[0]
+        for c in (copy.deepcopy(p), pickle.loads(pickle.dumps(p))):
+            self.assertIsNone(c._index)
+            self.assertEqual(c.to_str(), p.to_str())
+        self.assertNotIn(b"_Index", pickle.dumps(p))
+        self.assertEqual(pickle.loads(pickle.dumps(xml)).find_all("p")[0].parent.tag, "body")
+
+
+class QueryTestCase(unittest.TestCase):
+    def test_query(self):
+        xml = xl.parse('<html><body><p class="x">a<a href="1"/><span><a href="2"/></span></p>'
+                       '<p>b<a href="3"/></p><p class="y"/></body></html>')
+
+        def hrefs(path):
+            return [e.attrs.get("href") for e in xml.iter_find(path)]
+
+        self.assertEqual(hrefs('html/body/p[@class="x"]//a'), ["1", "2"])
+        self.assertEqual(hrefs('//p[2]/a'), ["3"])
+        self.assertEqual(hrefs('//p[text()="b"]/*'), ["3"])
+        self.assertEqual(hrefs('//a[contains(@href, "2")]'), ["2"])
+        self.assertEqual(xml.find('//p[last()]').attrs, {"class": "y"})
+        self.assertEqual(xml.root.find("body/p").attrs, {"class": "x"})
+        self.assertIsNone(xml.find("//table"))
+
+    def test_index_same_as_walk(self):
+        root = xl.parse_e('<r><p><a/><b/></p><a/></r>')
+        paths = ("//.", "//*", "//a", "p//.", "//a[1]")
+        expected = [[e.tag for e in root.iter_find(path)] for path in paths]
+        root.build_index()
+        self.assertEqual([[e.tag for e in root.iter_find(path)] for path in paths], expected)
+
+    def test_bad_query(self):
+        for path in ("", "/html", "a[", "a[@b=]", "a]"):
+            self.assertRaises(xl.QueryError, xl.Element("a").find, path)
+
+
+class BytesTestCase(unittest.TestCase):
+    def test_encodings(self):
+        text = '<?xml version="1.0" encoding="GBK"?>\n<a t="中">如是我聞</a>'
+        for data in (text.encode("gbk"), text.replace("GBK", "UTF-8").encode("utf-8-sig"),
+                     text.replace("GBK", "UTF-16").encode("utf-16")):
+            for chunk_size in (1, 1024):
+                xml = xl.parse_bytes(memoryview(data), chunk_size=chunk_size)
+                self.assertEqual(xml.root.attrs, {"t": "中"})
+                self.assertEqual(xml.root.kids, ["如是我聞"])
+                events = list(xl.iterparse(io.BytesIO(data), chunk_size=chunk_size))
+                self.assertEqual(events[-1][1].kids, ["如是我聞"])
+
+    def test_parse_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "a.xml")
+            with open(path, "wb") as f:
+                f.write(_xml1_text.encode())
+            self.assertEqual(xl.parse_file(path).to_str(), xl.parse(_xml1_text).to_str())
+
+    def test_unknown_encoding(self):
+        self.assertRaises(xl.ParseError, xl.parse_bytes, b'<?xml version="1.0" encoding="nope"?><a/>')
+
+
+class ParseManyTestCase(unittest.TestCase):
+    def test_parse_many(self):
+        texts = [_xml1_text, xml3_text, "<a>" * 5000 + "</a>" * 5000, "<!--c--><b x='1'>t</b>"]
+        with tempfile.TemporaryDirectory() as d:
+            paths = []
+            for n, text in enumerate(texts):
+                paths.append(os.path.join(d, "{}.xml".format(n)))
+                with open(paths[-1], "w", encoding="utf-8") as f:
+                    f.write(text)
+
+            expected = [xl.parse(text).to_str(self_closing=None) for text in texts]
+            for workers, ordered in ((1, True), (2, True), (2, False)):
+                results = list(xl.parse_many(paths, workers=workers, ordered=ordered))
+                if ordered:
+                    self.assertEqual([p for p, x in results], paths)
+                results.sort(key=lambda x: paths.index(x[0]))
+                self.assertEqual([x.to_str(self_closing=None) for p, x in results], expected)
+                self.assertIs(type(results[0][1].prolog), xl.Prolog)
+
+    def test_error(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "bad.xml")
+            with open(path, "w") as f:
+                f.write("<a><b></a>")
+            self.assertRaises(xl.ParseError, list, xl.parse_many([path], workers=2))
+
+
+class BinaryTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        xml = xl.parse(_xml1_text)
+        xml.root.kids.append("\ud800 中文")
+        bio = io.BytesIO()
+        xl.dump_binary(xml, bio)
+        bio.seek(0)
+        xml2 = xl.load_binary(bio)
+        self.assertEqual(xml2.to_str(self_closing=None), xml.to_str(self_closing=None))
+        self.assertEqual([type(x) for x in xml2.kids], [type(x) for x in xml.kids])
+
+        data = bio.getvalue()
+        for bad in (b"", b"abcd" + data[4:], data[:-1]):
+            self.assertRaises(xl.ParseError, xl.load_binary, io.BytesIO(bad))
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "a.xml")
+            cache_dir = os.path.join(d, "cache")
+            with open(path, "w") as f:
+                f.write("<a>1</a>")
+            self.assertEqual(xl.parse_file(path, cache_dir=cache_dir).root.kids, ["1"])
+            cached, = os.listdir(cache_dir)
+
+            # 内容相同时，即使 mtime 变了也读缓存
+            with open(os.path.join(cache_dir, cached), "r+b") as f:
+                f.seek(xl._cache_header.size)
+                f.truncate()
+                xl.dump_binary(xl.parse("<a>2</a>"), f)
+            os.utime(path, ns=(0, 0))
+            self.assertEqual(xl.parse_file(path, cache_dir=cache_dir).root.kids, ["2"])
+            self.assertEqual(xl.parse_file(path, cache_dir=cache_dir).root.kids, ["2"])
+
+            with open(path, "w") as f:
+                f.write("<a>3</a>")
+            self.assertEqual(xl.parse_file(path, cache_dir=cache_dir).root.kids, ["3"])
+
+
+class ParseCacheTestCase(unittest.TestCase):
+    def test_cache(self):
+        cache = xl.ParseCache()
+        xml1 = cache.parse(_xml1_text)
+        xml1.root.kids.clear()
+        xml2 = cache.parse(_xml1_text)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(xml2.to_str(), xl.parse(_xml1_text).to_str())
+        self.assertIsNot(xml2.root, cache.parse(_xml1_text).root)
+
+        cache.parse(_xml1_text, ignore_comment=True)
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (2, 2, 2))
+
+    def test_eviction(self):
+        cache = xl.ParseCache(max_entries=2)
+        for text in ("<a/>", "<b/>", "<a/>", "<c/>", "<b/>"):
+            cache.parse(text)
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (1, 4, 2))
+
+        cache = xl.ParseCache(max_size=100)
+        cache.parse("<a>{}</a>".format("x" * 200))
+        self.assertEqual((len(cache), cache.size), (0, 0))
+
+
+class StatsTestCase(unittest.TestCase):
+    def test_parse(self):
+        timed = []
+        stats = xl.Stats(hook=lambda e, seconds: timed.append(e.tag), top=2)
+        xml = xl.parse(_xml1_text, stats=stats)
+        self.assertEqual(xml.to_str(), xl.parse(_xml1_text).to_str())
+        self.assertEqual(stats.counts, {"element": 8, "text": 4, "comment": 1, "pi": 3, "doctype": 1})
+        self.assertEqual(stats.max_depth, 4)
+        self.assertEqual(stats.chars, len(_xml1_text))
+        self.assertEqual(stats.largest_texts, ["Virtual Library", "example.org"])
+        self.assertEqual(timed, ["title", "sf", "head", "a", "p", "span", "body", "html"])
+        for phase in ("tags", "attrs", "text", "comments", "parse"):
+            self.assertGreater(stats.times[phase], 0)
+
+        xl.parse_e(xml3_text, stats=stats)
+        self.assertEqual(stats.counts["element"], 10)
+        self.assertRaises(ValueError, xl.parse, _xml1_text, lazy=True, stats=xl.Stats())
+
+    def test_to_str(self):
+        stats = xl.Stats()
+        xml = xl.parse(_xml1_text)
+        s = xml.to_str(stats=stats)
+        self.assertEqual(s, xml.to_str())
+        self.assertEqual(stats.chars, len(s))
+        self.assertEqual(stats.counts["element"], 8)
+        self.assertEqual(xml.root.to_str(stats=stats), xml.root.to_str())
+
+
+class TargetTestCase(unittest.TestCase):
+    def test_events(self):
+        class Target(object):
+            def __init__(self):
+                self.events = []
+
+            def __getattr__(self, name):
+                return lambda *args: self.events.append((name,) + args)
+
+            def close(self):
+                return self.events
+
+        events = xl.parse('<?pi a="1"?><!DOCTYPE x><r k="&lt;"> t <b/><!--c--></r>', target=Target())
+        self.assertEqual(events, [("pi", "pi", {"a": "1"}), ("doctype", "x"), ("start", "r", {"k": "<"}),
+                                  ("data", "t"), ("empty", "b", {}), ("comment", "c"), ("end", "r")])
+
+    def test_tree_builder(self):
+        for kwargs in ({}, {"dont_do_tags": ["p"]}, {"ignore_comment": True}):
+            xml = xl.parse(_xml1_text, target=xl.TreeBuilder(), **kwargs)
+            self.assertEqual(xml.to_str(), xl.parse(_xml1_text, **kwargs).to_str())
+
+    def test_partial_target(self):
+        class Counter(object):
+            count = 0
+
+            def start(self, tag, attrs):
+                self.count += 1
+
+        counter = Counter()
+        self.assertIsNone(xl.parse("<a><b/><c>x</c></a>", target=counter))
+        self.assertEqual(counter.count, 3)
+        self.assertRaises(xl.ParseError, xl.parse, "<a><b></a>", target=counter)
+        self.assertRaises(xl.ParseError, xl.parse, "<a>", target=counter)
+        for kwargs in ({"lazy": True}, {"index": True}, {"parents": True}, {"stats": xl.Stats()}):
+            self.assertRaises(ValueError, xl.parse, "<a/>", target=xl.TreeBuilder(), **kwargs)
+
+
+class SelectiveTestCase(unittest.TestCase):
+    def test_skip(self):
+        xml = xl.parse(_xml1_text, skip="head")
+        self.assertEqual([e.tag for e in xml.root.kids], ["body"])
+        xml = xl.parse(_xml1_text, skip=lambda tag, attrs: "href" in attrs)
+        self.assertEqual(xml.root.find("body/p").kids, ["Moved to", ".", xml.root.find("body/p").kids[2]])
+
+    def test_keep(self):
+        xml = xl.parse(_xml1_text, keep="body")
+        self.assertEqual(xml.root.to_str(), xl.parse(_xml1_text).root.find("body").to_str())
+        self.assertIs(type(xml.prolog), xl.Prolog)
+
+        xml = xl.parse('<r><p>1<p>2</p></p>x<d><p k="v"/></d></r>', keep=["p"])
+        self.assertEqual([e.to_str() for e in xml.kids], ["<p>1<p>2</p></p>", '<p k="v"/>'])
+        xml = xl.parse('<r><p>1</p><p k="v"/></r>', keep=lambda tag, attrs: attrs.get("k") == "v", skip="x")
+        self.assertEqual([e.to_str() for e in xml.kids], ['<p k="v"/>'])
+
+    def test_mixed(self):
+        # keep 按名字、skip 是函数时，穿过去的元素也要检查 skip
+        text = '<r><div x="1"><p>a</p></div><div><p>b</p></div></r>'
+        skip = lambda tag, attrs: attrs.get("x") == "1"
+        for keep in ("p", lambda tag, attrs: tag == "p"):
+            self.assertEqual([e.to_str() for e in xl.parse(text, keep=keep, skip=skip).kids], ["<p>b</p>"])
+
+    def test_errors(self):
+        self.assertRaises(xl.ParseError, xl.parse, "<r><a><b></a></r>", skip="a")
+        self.assertRaises(xl.ParseError, xl.parse, "<r><a>", keep="a")
+        self.assertRaises(ValueError, xl.parse, "<r/>", keep="a", lazy=True)
+        hooked = xl.Stats(hook=lambda e, seconds: None)
+        self.assertRaises(ValueError, xl.parse, "<r><p/></r>", keep="p", stats=hooked)
+        self.assertRaises(ValueError, xl.parse, "<r><p/></r>", skip="p", stats=hooked)
+        stats = xl.Stats()
+        self.assertEqual([e.tag for e in xl.parse("<r><p/></r>", keep="p", stats=stats).kids], ["p"])
+
+
+class StrCacheTestCase(unittest.TestCase):
+    def test_cache(self):
+        xml = xl.parse("<r><a><b>1</b></a><c><d>2</d></c></r>")
+        index = xml.build_str_cache()
+        self.assertEqual(xml.to_str(), "<r><a><b>1</b></a><c><d>2</d></c></r>\n")
+        a, c = xml.root.kids
+        c_str = index.renders[id(c)]
+
+        a.kids[0].kids.append("x")
+        self.assertNotIn(id(a), index.renders)
+        self.assertNotIn(id(xml.root), index.renders)
+        self.assertIs(index.renders[id(c)], c_str)
+        self.assertEqual(xml.to_str(), "<r><a><b>1x</b></a><c><d>2</d></c></r>\n")
+
+        c.ekid("e").self_closing = False
+        a.attrs["k"] = "v"
+        c.kids[0].tag = "f"
+        self.assertEqual(xml.to_str(self_closing=None), '<r><a k="v"><b>1x</b></a><c><f>2</f><e></e></c></r>\n')
+        plain = xl.Xml(root=xl.parse_e(xml.root.to_str(self_closing=None)))
+        plain.root.find("a/b").kids[:] = ["1", "x"]
+        self.assertEqual(xml.to_str(do_pretty=True), plain.to_str(do_pretty=True))
+
+    def test_comment(self):
+        xml = xl.parse("<r><a><!--x--></a><b/></r>")
+        xml.build_str_cache()
+        xml.to_str()
+        comment = xml.root.kids[0].kids[0]
+        comment.text = "y"
+        self.assertEqual(xml.root.to_str(), "<r><a><!--y--></a><b/></r>")
+        # 移到别的元素之后，修改仍然生效
+        xml.root.kids[1].kids.append(xml.root.kids[0].kids.pop())
+        self.assertEqual(xml.root.to_str(), "<r><a/><b><!--y--></b></r>")
+        comment.text = "z"
+        self.assertEqual(xml.root.to_str(), "<r><a/><b><!--z--></b></r>")
+
+    def test_replaced_subtrees(self):
+        # 换下来的子树不能一直留在各张表里
+        xml = xl.parse("<r>" + "<a><b>x</b></a>" * 10 + "</r>")
+        index = xml.build_str_cache()
+        xml.track_parents()
+        for i in range(2000):
+            xml.root.kids[i % 10] = xl.parse_e("<a><b>%d</b></a>" % i)
+            xml.to_str()
+            xl.equal(xml.root, xml.root)
+        self.assertLess(len(index.renders) + len(index.parents) + len(index.digests), 1000)
+        moved = xml.root.kids[0]
+        del xml.root.kids[0]
+        index.sweep()
+        xml.root.kids[0].kids.append(moved)
+        self.assertIs(moved.kids[0].parent, moved)
+        self.assertEqual(xml.root.kids[0].to_str(), "<a><b>1991</b><a><b>1990</b></a></a>")
+
+
+class DigestTestCase(unittest.TestCase):
+    def test_equal(self):
+        a = xl.parse(_xml1_text).root
+        b = xl.parse(_xml1_text).root
+        self.assertTrue(xl.equal(a, b))
+        self.assertNotEqual(a, b)
+        self.assertEqual(a.digest(), b.digest())
+        self.assertTrue(xl.equal(xl.parse_e('<a x="1" y="2"/>'), xl.parse_e("<a y='2' x='1'></a>")))
+        self.assertFalse(xl.equal(a, xl.parse(_xml1_text, ignore_comment=True).root))
+        # 没有索引时计算摘要不改动树
+        self.assertIsNone(a._index)
+
+        a.build_index()
+        digest = a.digest()
+        a.find("body/p/a").attrs["href"] = "x"
+        self.assertNotEqual(a.digest(), digest)
+        self.assertFalse(xl.equal(a, b))
+        a.find("body/p/a").attrs["href"] = "http://example.org/"
+        self.assertEqual(a.digest(), digest)
+        a.find("head").ckid("c").text = "d"
+        digest = a.digest()
+        a.find("head").kids[-1].text = "e"
+        self.assertNotEqual(a.digest(), digest)
+
+    def test_identity(self):
+        # == 仍按对象身份，结构相同的兄弟互不影响
+        r = xl.parse_e("<r><br/><x/><br/></r>")
+        b1, x, b2 = r.kids
+        r.kids.remove(b2)
+        self.assertIs(r.kids[0], b1)
+        self.assertEqual(r.to_str(do_pretty=True, dont_do_tags=[b1]), "<r>\n    <br/>\n    <x/>\n</r>")
+        r.kids[1].ekid("y")
+        r.kids.append(xl.parse_e("<r><x><y/></x></r>").kids[0])
+        self.assertEqual(r.to_str(do_pretty=True, dont_do_tags=[r.kids[1]]),
+                         "<r>\n    <br/>\n    <x><y/></x>\n    <x>\n        <y/>\n    </x>\n</r>")
+
+    def test_diff(self):
+        a = xl.parse(_xml1_text)
+        b = xl.parse(_xml1_text)
+        self.assertEqual(xl.diff(a, b), [])
+
+        b.root.find("body/p/a").attrs["href"] = "x"
+        b.root.find("head/title").kids[0] = "New"
+        b.root.find("body").ekid("hr")
+        self.assertEqual([change[:2] for change in xl.diff(a, b)],
+                         [("html/head[1]/title[1]", "removed"), ("html/head[1]/title[1]", "added"),
+                          ("html/body[1]", "added"), ("html/body[1]/p[1]/a[1]", "attrs")])
+        self.assertEqual(xl.diff(xl.Element("a"), xl.Element("b"))[0][1], "tag")
+
+
+class WriteTestCase(unittest.TestCase):
+    def test_write(self):
+        xml = xl.parse(_xml1_text, dont_do_tags=["p"])
+        for kwargs in ({}, {"do_pretty": True, "dont_do_tags": ["p"]}, {"self_closing": False}):
+            s = xml.to_str(**kwargs)
+            self.assertEqual("".join(xml.iter_str(**kwargs)), s)
+
+            sio = io.StringIO()
+            xml.write(sio, **kwargs)
+            self.assertEqual(sio.getvalue(), s)
+
+            bio = io.BytesIO()
+            xml.write(bio, **kwargs)
+            self.assertEqual(bio.getvalue(), s.encode("utf-8"))
+
+    def test_element_write(self):
+        e = xl.parse_e('<a href="x&amp;y"><b/>中文</a>')
+        bio = io.BytesIO()
+        e.write(bio, encoding="ascii")
+        self.assertEqual(bio.getvalue(), b'<a href="x&amp;y"><b/>&#20013;&#25991;</a>')
+
+
+class IterparseTestCase(unittest.TestCase):
+    def test_same_as_parse(self):
+        xml1 = xl.parse(_xml1_text, dont_do_tags=["p"])
+        kids = []
+        depth = 0
+        for event, obj in xl.iterparse(io.BytesIO(_xml1_text.encode()), events=("start", "end", "pi", "doctype"),
+                                       dont_do_tags=["p"], chunk_size=5):
+            if event == "start":
+                if depth == 0:
+                    kids.append(obj)
+                depth += 1
+            elif event == "end":
+                depth -= 1
+            elif depth == 0:
+                kids.append(obj)
+        xml2 = xl.Xml()
+        xml2.kids.extend(kids)
+        self.assertEqual(xml1.to_str(), xml2.to_str())
+
+    def test_events(self):
+        events = [(event, getattr(obj, "tag", obj))
+                  for event, obj in xl.iterparse(io.StringIO("<a>x<b/><!--c--></a>"),
+                                                 events=("start", "end", "text", "comment"))]
+        self.assertEqual(events[:4], [("start", "a"), ("text", "x"), ("start", "b"), ("end", "b")])
+        self.assertEqual(events[-1], ("end", "a"))
+
+    def test_clear(self):
+        root = None
+        for event, e in xl.iterparse(io.StringIO("<r><p>1</p><p>2</p></r>"), events=("start", "end")):
+            if root is None:
+                root = e
+            elif event == "end" and e.tag == "p":
+                e.clear()
+                root.kids.clear()
+        self.assertEqual(root.kids, [])
+
+    def test_unclosed(self):
+        self.assertRaises(xl.ParseError, list, xl.iterparse(io.StringIO("<a><b></b>")))
+
+
+class FeedParserTestCase(unittest.TestCase):
+    def test_any_split(self):
+        text = '<?xml version="1.0" encoding="UTF-8"?><a x="1 &amp; 2"><!--如是--><b>&#x4E2D;&lt;</b><c/></a>'
+        expected = xl.parse(text).to_str()
+        data = text.encode()
+        for n in range(1, len(data)):
+            parser = xl.FeedParser()
+            parser.feed(data[:n])
+            parser.feed(data[n:])
+            self.assertEqual(parser.close().to_str(), expected)
+
+    def test_events(self):
+        parser = xl.FeedParser(events=("start", "end"))
+        parser.feed("<a><b")
+        self.assertEqual([(event, e.tag) for event, e in parser.read_events()], [("start", "a")])
+        parser.feed("/></a>")
+        self.assertEqual([(event, e.tag) for event, e in parser.read_events()],
+                         [("start", "b"), ("end", "b"), ("end", "a")])
+        parser.close()
+
+    def test_unclosed(self):
+        parser = xl.FeedParser()
+        parser.feed("<a><!-- x")
+        self.assertRaises(xl.ParseError, parser.close)
+
+    def test_stream(self):
+        async def run(data, func, **kwargs):
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            return [x async for x in func(reader, chunk_size=3, **kwargs)]
+
+        data = "<s><m n='1'>如是</m><m n='2'/></s>".encode()
+        events = asyncio.run(run(data, xl.aiterparse, events=("start", "end")))
+        self.assertEqual([(event, e.tag) for event, e in events][:2], [("start", "s"), ("start", "m")])
+        self.assertEqual(events[-1][1].to_str(), "<s><m n=\"1\">如是</m><m n=\"2\"/></s>")
+
+        elements = asyncio.run(run(data, xl.aiter_elements))
+        self.assertEqual([e.attrs["n"] for e in elements], ["1", "2"])
+        root, = asyncio.run(run(data, xl.aiter_elements, depth=0))
+        self.assertEqual(len(root.kids), 2)
+
+
+class NamesTestCase(unittest.TestCase):
+    def test_intern(self):
+        text = '<a><b k="1"/><b k="2"/></a>'
+        xml = xl.parse(text)
+        b1, b2 = xml.root.kids
+        self.assertIs(b1.tag, b2.tag)
+        self.assertIs(list(b1.attrs)[0], list(b2.attrs)[0])
+        names = xl.Names()
+        for func in (xl.parse, lambda t, names: xl.parse_bytes(t.encode(), names=names),
+                     lambda t, names: xl.parse(t, lazy=True, names=names)):
+            a = func(text, names=names).root
+            self.assertIs(a.kids[0].tag, names["b"])
+
+    def test_namespace(self):
+        text = '<r xmlns="urn:a" xmlns:b="urn:b"><b:x b:k="1"/><x/><y xmlns=""><x/></y></r>'
+        for xml in (xl.parse(text), xl.parse(text, index=True)):
+            self.assertEqual(xml.find_all("x", namespace="urn:a"), [xml.root.kids[1]])
+            self.assertEqual(len(xml.find_all("x", namespace="")), 1)
+        # 元素上的查找要知道祖先上的声明
+        doc = xl.parse('<r xmlns="urn:a" xmlns:b="urn:b"><body><x/><b:x/></body></r>')
+        body = doc.root.kids[0]
+        self.assertRaises(ValueError, body.find_all, "x", namespace="urn:a")
+        self.assertEqual(body.find_all("y", namespace="urn:a"), [])
+        self.assertEqual(doc.root.find_all("x", namespace="urn:b"), [body.kids[1]])
+        self.assertEqual(body.find_all("x", namespace="urn:a", nsmap={"": "urn:a"}), [body.kids[0]])
+        doc.track_parents()
+        self.assertEqual(body.find_all("x", namespace="urn:a"), [body.kids[0]])
+        self.assertEqual(body.find_all("x", namespace="urn:b"), [body.kids[1]])
+        self.assertEqual(body.find_all("x", namespace=""), [])
+        body.kids[0].tag = "b:x"
+        self.assertEqual(body.find_all("x", namespace="urn:b"), body.kids)
+        names = xl.Names()
+        e, qname, nsmap = next(names.iter_resolved([xml.root.kids[0]], {"b": "urn:b"}))
+        self.assertIs(qname, names.pair("urn:b", "x"))
+        self.assertEqual(names.resolve("b:k", nsmap, is_attr=True), ("urn:b", "k"))
+        self.assertEqual(names.resolve("xml:id", nsmap, is_attr=True), (xl.XML_NAMESPACE, "id"))
+
+
+class BuildTestCase(unittest.TestCase):
+    def test_same_as_per_node(self):
+        root = xl.Element("r")
+        p = root.ekid("p", {"id": "1"})
+        p.skid("如是")
+        p.ekid("b").skid("我聞")
+        p.ekid("lb")
+        root.ckid("c")
+        expected = root.to_str()
+        comment = xl.Comment("c")
+        self.assertEqual(xl.build(["r", ("p", {"id": "1"}, "如是", ("b", "我聞"), ("lb",)), comment]).to_str(),
+                         expected)
+        E = xl.E
+        self.assertEqual(E.r(E.p({"id": "1"}, "如是", E.b("我聞"), E.lb()), comment).to_str(), expected)
+        self.assertEqual(E("r", None, ("p", {"id": "1"}, "如是", ("b", "我聞"), ("lb",)), comment).to_str(), expected)
+
+    def test_validate(self):
+        self.assertRaises(ValueError, xl.build, ("r", ("p", {"id": 1})))
+        self.assertRaises(ValueError, xl.build, ("r", (None,)))
+        self.assertRaises(TypeError, xl.build, ("r", ("p", 1)))
+        self.assertRaises(ValueError, xl.E.p, {"id": 1})
+        self.assertRaises(ValueError, xl.E, "")
+        attrs = {"id": "1"}
+        e = xl.E("cb:div", attrs)
+        attrs["id"] = "2"
+        self.assertEqual(xl.E("cb:div", e).to_str(), '<cb:div><cb:div id="1"/></cb:div>')
+        self.assertEqual(xl.build(("r", ("p", {"id": 1})), validate=False).kids[0].attrs, {"id": 1})
+
+    def test_extend_kids(self):
+        root = xl.Element("r")
+        root.build_index()
+        self.assertEqual(root.find_all("p"), [])
+        kids = root.extend_kids([("p", "1"), "x", ("p", ("q",))])
+        self.assertEqual(len(kids), 3)
+        self.assertEqual(len(root.find_all("p")), 2)
+        self.assertEqual(root.to_str(), "<r><p>1</p>x<p><q/></p></r>")
+
+    def test_deep(self):
+        spec = ("d",)
+        for _ in range(100000):
+            spec = ("d", spec)
+        e = xl.build(spec)
+        self.assertEqual(len(e.to_str()), 100001 * 7 - 3)
+
+
+class ParentsTestCase(unittest.TestCase):
+    def test_navigation(self):
+        xml = xl.parse("<r><p><lb/>x<b/></p><q/></r>", parents=True)
+        p, q = xml.root.kids
+        lb, x, b = p.kids
+        self.assertIs(b.parent, p)
+        self.assertEqual(b.index_in_parent, 2)
+        self.assertEqual(lb.next, "x")
+        self.assertEqual(b.previous, "x")
+        self.assertIsNone(b.next)
+        self.assertIs(p.next, q)
+        self.assertEqual([e.tag for e in b.iter_ancestors()], ["p", "r"])
+        self.assertIsNone(xml.root.parent)
+
+    def test_mutation(self):
+        root = xl.build(("r", ("p", ("b",)), ("q",)))
+        root.track_parents()
+        p, q = root.kids
+        b = p.kids[0]
+        root.kids.insert(0, "t")
+        self.assertEqual(q.index_in_parent, 2)
+        q.kids.append(b)
+        p.kids.remove(b)
+        self.assertIs(b.parent, q)
+        new = xl.build(("n", ("m",)))
+        p.kids[0:0] = [new]
+        self.assertEqual([e.tag for e in new.kids[0].iter_ancestors()], ["n", "p", "r"])
+        del root.kids[1]
+        self.assertIsNone(p.parent)
+        root.build_index()
+        self.assertIs(b.parent, q)
+
+    def test_off(self):
+        xml = xl.parse("<r><p/></r>")
+        self.assertRaises(ValueError, getattr, xml.root.kids[0], "parent")
+
+
+class TextTestCase(unittest.TestCase):
+    def test_itertext(self):
+        text = '<p>如是<!--c--><note n="1">註</note>我聞<lb/>一時<hi>佛</hi></p>'
+        p = xl.parse(text).root
+        self.assertEqual(list(p.itertext()), ["如是", "註", "我聞", "一時", "佛"])
+        self.assertEqual(p.text_content(skip_tags="note"), "如是我聞一時佛")
+        self.assertEqual(p.text_content(skip_tags=lambda tag, attrs: "n" in attrs, with_tail_separators=True),
+                         "如是\n我聞\n一時佛")
+        self.assertEqual(p.text_content(with_tail_separators="|"), "如是註|我聞|一時佛")
+
+    def test_iterparse_text(self):
+        p = xl.parse(_xml1_text).root
+        for skip_tags in (None, ["p"]):
+            for chunk_size in (7, 65536):
+                self.assertEqual("".join(xl.iterparse_text(io.BytesIO(_xml1_text.encode()), skip_tags, " ",
+                                                           chunk_size=chunk_size)),
+                                 p.text_content(skip_tags, " "))
+
+
+class WhitespaceTestCase(unittest.TestCase):
+    text = ('<r>\n  <p> a  <b>b</b>\n  c </p>\n  <pre xml:space="preserve"> x <i> y </i><lb/>\n'
+            '    <q xml:space="default"> z </q></pre>\n</r>')
+
+    def _all(self, **kwargs):
+        # 各种解析方式的结果应当相同
+        results = [xl.parse(self.text, **kwargs), xl.parse(self.text, lazy=True, **kwargs),
+                   xl.parse_bytes(self.text.encode(), chunk_size=5, **kwargs),
+                   xl.parse(self.text, target=xl.TreeBuilder(), **kwargs),
+                   xl.parse(self.text, skip={"none"}, **kwargs)]
+        for xml in results[1:]:
+            self.assertEqual(xml.to_str(), results[0].to_str())
+        return results[0].root
+
+    def test_strip(self):
+        r = self._all()
+        self.assertEqual(r.kids[0].kids, ["a", r.kids[0].kids[1], "c"])
+        self.assertEqual(r.kids[1].kids[:2], [" x ", r.kids[1].kids[1]])
+        self.assertEqual(r.kids[1].kids[1].kids, [" y "])
+        self.assertEqual(r.kids[1].kids[3:], ["\n    ", r.kids[1].kids[4]])
+        self.assertEqual(r.kids[1].kids[4].kids, ["z"])
+
+    def test_preserve(self):
+        for kwargs in ({"whitespace": "preserve"}, {"do_strip": False}):
+            r = self._all(**kwargs)
+            self.assertEqual(r.kids[0], "\n  ")
+            self.assertEqual(r.kids[1].kids[0], " a  ")
+            self.assertEqual(r.kids[-1], "\n")
+
+    def test_collapse(self):
+        r = self._all(whitespace="collapse")
+        self.assertEqual(r.kids[0], " ")
+        self.assertEqual(r.kids[1].kids, [" a ", r.kids[1].kids[1], " c "])
+        self.assertEqual(r.kids[3].kids[4].kids, [" z "])
+
+    def test_per_tag(self):
+        r = self._all(whitespace={"p": "collapse", None: "strip"})
+        self.assertEqual(r.kids[0].kids[0], " a ")
+        self.assertEqual(r.kids[0].kids[1].kids, ["b"])
+        r = self._all(dont_do_tags=["p"])
+        self.assertEqual(r.kids[0].kids[0], " a  ")
+        self.assertRaises(ValueError, xl.parse, self.text, whitespace="trim")
+
+    def test_iterparse(self):
+        events = xl.iterparse(io.StringIO(self.text), ("text",), whitespace="collapse", chunk_size=3)
+        self.assertEqual([s for event, s in events][:3], [" ", " a ", "b"])
+
+
+class BenchTestCase(unittest.TestCase):
+    def test_run(self):
+        results = bench_xl.run(size=3000, repeat=1)
+        self.assertEqual(len(results), len(bench_xl.DOCS) * 5)
+        for r in results:
+            self.assertGreater(r["mb_per_s"], 0)
+            self.assertGreater(r["peak_bytes"], 0)
+
+
 if __name__ == '__main__':
     unittest.main()
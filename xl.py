@@ -7,7 +7,24 @@
 
 __version__ = "0.4.0"
 
+import codecs as _codecs
+import collections as _collections
+import concurrent.futures as _futures
+import difflib as _difflib
+import functools as _functools
+import hashlib as _hashlib
+import heapq as _heapq
+import io as _io
+import mmap as _mmap
+import os as _os
+import re as _re
+import struct as _struct
+import sys as _sys
+import threading as _threading
+import time as _time
+import types as _types
 from abc import abstractmethod as _abstractmethod
+from array import array as _array
 
 _xml_escape_table = (
     ('&', '&amp;'),  # I guess this must be the first one?
@@ -27,36 +44,60 @@ _xml_comment_escape_table = (
 )
 
 
-def _unescape(text, table):
-    _text = text
-    nt = ""
-    i = 0
-    while i < len(text):
-        unescaped = False
+def _compile_escape(table):
+    # 每个表编译成一串 str.replace，'&' 在表里排第一，所以不会重复转义；
+    # 没有特殊字符时，`in` 检查之后原样返回
+    def escape(text):
         for x, y in table:
-            if text[i: i + len(y)] == y:
-                nt += x
-                i += len(y)
-                unescaped = True
-                break
-        if not unescaped:
-            nt += text[i]
-            i += 1
-    return nt
+            if x in text:
+                text = text.replace(x, y)
+        return text
+    return escape
+
+
+_escape_cache = {}
 
 
 def _escape(text, table):
-    nt = ""
-    for c in text:
-        escaped = False
-        for x, y in table:
-            if c == x:
-                nt += y
-                escaped = True
-                break
-        if not escaped:
-            nt += c
-    return nt
+    try:
+        escape = _escape_cache[table]
+    except KeyError:
+        escape = _escape_cache[table] = _compile_escape(table)
+    return escape(text)
+
+
+_predefined_entities = {
+    "amp": "&",
+    "lt": "<",
+    "gt": ">",
+    "quot": '"',
+    "apos": "'",
+}
+
+_entity_re = _re.compile("&(?:#([0-9]+)|#x([0-9a-fA-F]+)|(amp|lt|gt|quot|apos));")
+
+
+def _replace_entity(m):
+    decimal, hexadecimal, name = m.groups()
+    if name:
+        return _predefined_entities[name]
+    code = int(decimal, 10) if decimal else int(hexadecimal, 16)
+    if 0 < code <= 0x10FFFF and not 0xD800 <= code <= 0xDFFF:
+        return chr(code)
+    return m.group()
+
+
+def _unescape(text):
+    # 一遍解开预定义实体和 &#NN; / &#xHH; 字符引用，认不出的 '&' 原样保留
+    if "&" not in text:
+        return text
+    if "&#" in text:
+        return _entity_re.sub(_replace_entity, text)
+    for name in ("lt", "gt", "quot", "apos", "amp"):
+        entity = "&" + name + ";"
+        if entity in text:
+            text = text.replace(entity, _predefined_entities[name])
+    return text
 
 
 def _is_straight_line(element):
@@ -85,12 +126,51 @@ class ToStrError(Exception):
 
 
 class _Node(object):
+    __slots__ = ()
+
     @_abstractmethod
     def to_str(self):
         pass
 
+    def iter_str(self, *args, **kwargs):
+        yield self.to_str(*args, **kwargs)
+
+    def write(self, fp, *args, encoding="utf-8", **kwargs):
+        _write(fp, self.iter_str(*args, **kwargs), encoding)
+
+
+_write_chunk_size = 65536
+
+
+def _is_binary(fp):
+    if isinstance(fp, _io.TextIOBase):
+        return False
+    if isinstance(fp, (_io.RawIOBase, _io.BufferedIOBase)):
+        return True
+    return "b" in getattr(fp, "mode", "")
+
+
+def _write(fp, pieces, encoding):
+    # 把小片段攒到 _write_chunk_size 再写，避免每个标签一次 write()
+    binary = _is_binary(fp)
+    buf = []
+    size = 0
+    for piece in pieces:
+        buf.append(piece)
+        size += len(piece)
+        if size >= _write_chunk_size:
+            chunk = "".join(buf)
+            fp.write(chunk.encode(encoding, "xmlcharrefreplace") if binary else chunk)
+            buf = []
+            size = 0
+    if buf:
+        chunk = "".join(buf)
+        fp.write(chunk.encode(encoding, "xmlcharrefreplace") if binary else chunk)
+
 
 class DocType(_Node):
+    __slots__ = ("text",)
+
     def __init__(self, text=None):
         self.text = text or "html"
 
@@ -102,15 +182,718 @@ class InitError(Exception):
     pass
 
 
+def _notifying(method):
+    def wrapper(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        index = self._owner._index
+        if index is not None:
+            self._owner._changed()
+            index.removed()
+        return result
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+
+class _Kids(list):
+    # .kids 交给调用者的总是 _Kids，任何修改都会通知 owner；owner 没有索引时什么也不做。
+    # 解析器等内部代码在新建的元素上直接用普通列表，它们不会被调用者拿到，建立索引时可以放心换成 _Kids
+    __slots__ = ("_owner",)
+
+    def __reduce_ex__(self, protocol):
+        # 复制、pickle 时还原成普通列表，索引重建时会再次包装
+        return list, (list(self),)
+
+    # 加入子节点的方法另外告诉索引加入了什么，跟踪父节点时要用。没有索引的树只多一次属性检查
+    def append(self, item):
+        list.append(self, item)
+        if self._owner._index is not None:
+            self._added((item,))
+
+    def insert(self, i, item):
+        list.insert(self, i, item)
+        if self._owner._index is not None:
+            self._added((item,))
+
+    def extend(self, items):
+        n = len(self)
+        list.extend(self, items)
+        if self._owner._index is not None:
+            self._added(self[n:])
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            value = list(value)
+            list.__setitem__(self, key, value)
+            self._added(value)
+        else:
+            list.__setitem__(self, key, value)
+            self._added((value,))
+        if self._owner._index is not None:
+            self._owner._index.removed()
+
+    def _added(self, items):
+        owner = self._owner
+        index = owner._index
+        if index is not None:
+            if index.dirty is not None:
+                index.adopt(owner, items)
+            index.changed(owner)
+
+
+for _name in ("remove", "pop", "clear", "sort", "reverse", "__delitem__", "__imul__"):
+    setattr(_Kids, _name, _notifying(getattr(list, _name)))
+
+
+class _Attrs(dict):
+    # 同 _Kids
+    __slots__ = ("_owner",)
+
+    def __reduce_ex__(self, protocol):
+        return dict, (dict(self),)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        if self._owner._index is not None:
+            self._owner._changed()
+
+
+for _name in ("__delitem__", "clear", "pop", "popitem", "setdefault", "update", "__ior__"):
+    setattr(_Attrs, _name, _notifying(getattr(dict, _name)))
+
+
+def _new_kids(owner, kids=()):
+    # 不定义 __init__，构造时少一次 Python 调用
+    kids = _Kids(kids)
+    kids._owner = owner
+    return kids
+
+
+def _new_attrs(owner, attrs=()):
+    attrs = _Attrs(attrs)
+    attrs._owner = owner
+    return attrs
+
+
+def _watch(node, index):
+    # 还没有 kids、attrs 的节点不需要包装，访问 .kids、.attrs 时会直接建立 _Kids、_Attrs。
+    # 已经是 _Kids、_Attrs 的不换，调用者手里的引用仍然是树上的那一个
+    node._index = index
+    if _load(node) is not None and type(node._kids) is not _Kids:
+        node._kids = _new_kids(node, node._kids)
+    if isinstance(node, Element) and node._attrs is not None and type(node._attrs) is not _Attrs:
+        node._attrs = _new_attrs(node, node._attrs)
+
+
+def _kids_of(node):
+    # 内部用：不经过 .kids，新建的元素上是普通列表；已经交给调用者的 _Kids 照常使用
+    kids = _load(node)
+    if kids is None:
+        kids = node._kids = []
+    return kids
+
+
+def _iter_elements(nodes):
+    # 先序遍历 nodes 及其后代中的 Element，不递归
+    stack = [x for x in reversed(nodes) if isinstance(x, Element)]
+    while stack:
+        e = stack.pop()
+        yield e
+        if _load(e):
+            stack.extend(x for x in reversed(e._kids) if isinstance(x, Element))
+
+
+class _Index(object):
+    # tag → 元素列表（文档顺序），属性值 → 元素。树被修改后标记为过期，下次查询时重建。
+    # renders 不是 None 时还缓存每个元素上次的 to_str 输出（见 _render_cached），
+    # 元素被修改时沿 parents 丢掉它和所有祖先的缓存。
+    # parents 是 id(元素) → (元素, 父节点, 在父节点 kids 中的位置)；dirty 不是 None 时（见 track_parents）
+    # 它覆盖整棵树，kids 被修改过的节点记在 dirty 里，查询前由 fix_parents 补上
+    def __init__(self, owner, attrs):
+        self.owner = owner
+        self.attr_names = tuple(attrs)
+        self.stale = True
+        self.tags = {}
+        self.values = {}
+        self.kids = {}
+        self.renders = None
+        self.digests = {}
+        self.parents = {}
+        self.dirty = None
+        self.names = {}
+        self.limit = 1024
+
+    def __getstate__(self):
+        # 复制出来的树用的是普通列表，不能信任原来的结果
+        state = dict(self.__dict__)
+        state.update(stale=True, tags={}, values={}, kids={}, digests={}, parents={}, names={})
+        if self.renders is not None:
+            state["renders"] = {}
+        if self.dirty is not None:
+            state["dirty"] = [self.owner]
+        return state
+
+    def changed(self, node):
+        self.stale = True
+        self.kids.pop(id(node), None)
+        dirty = self.dirty
+        if dirty is not None and (not dirty or dirty[-1] is not node):
+            dirty.append(node)
+        renders = self.renders
+        digests = self.digests
+        if renders or digests:
+            parents = self.parents
+            while node is not None:
+                if renders:
+                    renders.pop(id(node), None)
+                digests.pop(id(node), None)
+                entry = parents.get(id(node))
+                node = entry[1] if entry is not None and entry[0] is node else None
+
+    def removed(self):
+        # 某个 kids 里有节点被移走或换掉之后调用
+        renders = self.renders
+        if len(self.parents) + len(self.digests) + len(self.kids) + len(self.names) + len(renders or ()) > self.limit:
+            self.sweep()
+
+    def sweep(self):
+        # 被移走的元素在各张表里的记录不会随 kids 的修改删掉（它可能只是挪到了树里别处），
+        # 表项比上次清理后多出树的大小时走一遍树，丢掉不在树里的，这样替换掉的子树不会一直留在内存里，
+        # 平摊到每次修改的开销是常数。还没解析的 _Pending 不展开，里面的元素本来就不在表里
+        live = {id(self.owner)}
+        stack = [self.owner]
+        while stack:
+            kids = stack.pop()._kids
+            if kids and type(kids) is not _Pending:
+                for x in kids:
+                    if isinstance(x, Element):
+                        live.add(id(x))
+                        stack.append(x)
+        total = 0
+        for name in ("parents", "digests", "kids", "names", "renders"):
+            table = getattr(self, name)
+            if table is not None:
+                table = {k: v for k, v in table.items() if k in live}
+                setattr(self, name, table)
+                total += len(table)
+        self.limit = total + len(live) + 256
+
+    def _nodes(self):
+        return [self.owner] if isinstance(self.owner, Element) else self.owner.kids
+
+    def track_parents(self):
+        if self.dirty is None:
+            _watch(self.owner, self)
+            self.dirty = [self.owner]
+        self.fix_parents()
+
+    def fix_parents(self):
+        # 重新记下 dirty 中各节点的子元素的位置。没有记录过的子元素整个子树都要走一遍
+        dirty = self.dirty
+        self.dirty = []
+        parents = self.parents
+        done = set()
+        new = []
+        for node in dirty:
+            if id(node) in done:
+                continue
+            done.add(id(node))
+            for pos, _kid in enumerate(_load(node) or ()):
+                if isinstance(_kid, Element):
+                    if _kid._index is not self or id(_kid) not in parents:
+                        new.append(_kid)
+                    parents[id(_kid)] = (_kid, node, pos)
+        self._add_subtrees(new)
+
+    def adopt(self, owner, items):
+        # 新加入 owner 的元素马上记下父节点，位置等 fix_parents 补上；从别的树来的子树整个接过来，
+        # 这样它们的 parent 也立即可用
+        parents = self.parents
+        new = []
+        for x in items:
+            if isinstance(x, Element):
+                if x._index is not self or id(x) not in parents:
+                    # 不在 parents 里的是被 sweep 清掉过的，子树的记录也要补上
+                    new.append(x)
+                parents[id(x)] = (x, owner, None)
+        self._add_subtrees(new)
+
+    def _add_subtrees(self, new):
+        parents = self.parents
+        while new:
+            e = new.pop()
+            _watch(e, self)
+            for pos, _kid in enumerate(_load(e) or ()):
+                if isinstance(_kid, Element):
+                    parents[id(_kid)] = (_kid, e, pos)
+                    new.append(_kid)
+
+    def locate(self, element):
+        # 返回 (父节点, 位置)，element 不在树里或是顶层元素时返回 None
+        if self.dirty:
+            self.fix_parents()
+        entry = self.parents.get(id(element))
+        if entry is None:
+            return None
+        kids = _load(entry[1]) or ()
+        pos = entry[2]
+        if entry[0] is not element or pos is None or pos >= len(kids) or kids[pos] is not element:
+            # 已经被移除了
+            return None
+        return entry[1], pos
+
+    def refresh(self):
+        if not self.stale:
+            return
+        tags = {}
+        values = {}
+        attr_names = self.attr_names
+        _watch(self.owner, self)
+        for e in _iter_elements(self._nodes()):
+            _watch(e, self)
+            tags.setdefault(e.tag, []).append(e)
+            for name in attr_names:
+                value = e._attrs.get(name) if e._attrs else None
+                if value is not None:
+                    values.setdefault(value, e)
+        self.tags = tags
+        self.values = values
+        self.names = {}
+        self.stale = False
+
+    def find_all(self, tag):
+        self.refresh()
+        return list(self.tags.get(tag, ()))
+
+    def find_all_ns(self, node, tag, namespace, nsmap):
+        # names 是 id(node) → (node, nsmap, _group_by_name 的结果)，node 以下按命名空间分好的元素，
+        # 树被修改或 nsmap 不同时重建
+        self.refresh()
+        entry = self.names.get(id(node))
+        if entry is None or entry[0] is not node or entry[1] != nsmap:
+            nodes = [node] if isinstance(node, Element) else node.kids
+            entry = self.names[id(node)] = (node, nsmap, _group_by_name(nodes, nsmap))
+        return list(entry[2].get((namespace or "", tag), ()))
+
+    def find_value(self, value):
+        self.refresh()
+        return self.values.get(value)
+
+    def find_kids(self, element, tag):
+        # kids 是 id(元素) → (元素, tag → 子元素)，不跟着 stale 整个重建：element 的 kids 变了由 changed 丢掉它这一项，
+        # 子元素改了 tag 时丢掉全部
+        entry = self.kids.get(id(element))
+        if entry is None or entry[0] is not element:
+            by_tag = {}
+            for _kid in _load(element) or ():
+                if isinstance(_kid, Element):
+                    if _kid._index is not self:
+                        # 刚加进来的子元素，改 tag 时要能通知到这里
+                        _watch(_kid, self)
+                    by_tag.setdefault(_kid.tag, []).append(_kid)
+            entry = self.kids[id(element)] = (element, by_tag)
+        return list(entry[1].get(tag, ()))
+
+
+def _build_index(owner, attrs):
+    # 原来的索引在跟踪父节点的话，新索引接着跟踪
+    old = owner._index
+    index = owner._index = _Index(owner, attrs)
+    index.refresh()
+    if old is not None and old.owner is owner and old.dirty is not None:
+        index.track_parents()
+    return index
+
+
+def _track_parents(owner):
+    index = owner._index
+    if index is None or index.owner is not owner:
+        index = owner._index = _Index(owner, ("id", "xml:id"))
+    index.track_parents()
+    return index
+
+
+def _build_str_cache(owner):
+    # 缓存借用索引的修改通知，已经有自己的索引时直接用它
+    index = owner._index
+    if index is None or index.owner is not owner:
+        index = owner.build_index()
+    if index.renders is None:
+        index.renders = {}
+    return index
+
+
+def _render_cached(element, index, do_pretty, begin_indent, step, char, dont_do_tags, self_closing):
+    # 与 iter_str 的输出相同。每个有子节点的元素输出后存进 index.renders：
+    # id → (元素, (传给它的 do_pretty, 缩进, 其他选项), 输出)，下次选项相同时直接用
+    renders = index.renders
+    parents = index.parents
+    options = (step, char, tuple(dont_do_tags), self_closing)
+    dont_do_elements = [x for x in dont_do_tags if isinstance(x, Element)]
+
+    entry = renders.get(id(element))
+    if entry is not None and entry[0] is element and entry[1] == (do_pretty, begin_indent, options):
+        return entry[2]
+
+    s, done = element._iter_begin(self_closing)
+    if done:
+        return s
+
+    do_pretty_ultimately = do_pretty and element.tag not in dont_do_tags and element not in dont_do_elements
+    stack = [(element, enumerate(element._kids), [s], do_pretty_ultimately, begin_indent, do_pretty)]
+    while stack:
+        element, kids, parts, do_pretty, begin_indent, given_pretty = stack[-1]
+        for pos, _kid in kids:
+            if do_pretty:
+                parts.append('\n' + char * (begin_indent + step))
+
+            if isinstance(_kid, str):
+                parts.append(_escape_element_string(_kid))
+
+            elif isinstance(_kid, Element):
+                if type(_kid).to_str is not Element.to_str:
+                    parts.append(_kid.to_str(do_pretty=do_pretty,
+                                             begin_indent=begin_indent + step,
+                                             step=step,
+                                             char=char,
+                                             dont_do_tags=dont_do_tags,
+                                             self_closing=self_closing))
+                    continue
+
+                if _kid._index is not index:
+                    _watch(_kid, index)
+                parents[id(_kid)] = (_kid, element, pos)
+                entry = renders.get(id(_kid))
+                if entry is not None and entry[0] is _kid and entry[1] == (do_pretty, begin_indent + step, options):
+                    parts.append(entry[2])
+                    continue
+
+                s, done = _kid._iter_begin(self_closing)
+                if done:
+                    parts.append(s)
+                    continue
+                do_pretty_ultimately = do_pretty and _kid.tag not in dont_do_tags and _kid not in dont_do_elements
+                stack.append((_kid, enumerate(_kid._kids), [s], do_pretty_ultimately, begin_indent + step, do_pretty))
+                break
+
+            elif isinstance(_kid, Comment):
+                _kid._owner = element
+                parts.append(_kid.to_str())
+            else:
+                raise TypeError("Kid type:{} not supported by to_str().".format(type(_kid)))
+        else:
+            stack.pop()
+            if do_pretty:
+                parts.append('\n' + char * begin_indent)
+            parts.append('</{}>'.format(element.tag))
+            s = "".join(parts)
+            renders[id(element)] = (element, (given_pretty, begin_indent, options), s)
+            if not stack:
+                return s
+            stack[-1][2].append(s)
+
+
+def _digest_fields(fields):
+    # repr 出来的列表没有歧义，又比逐段拼长度快得多
+    return _hashlib.blake2b(repr(fields).encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+
+def _kid_key(_kid, digests):
+    # 子节点在摘要和 diff 里的样子
+    if isinstance(_kid, str):
+        return "S", _kid
+    if isinstance(_kid, Comment):
+        return "C", _kid.text
+    if isinstance(_kid, DocType):
+        return "D", _kid.text
+    return "E", _element_digest(_kid, digests)
+
+
+def _element_digest(element, digests):
+    # 建立了索引的树用索引里缓存的摘要；否则用 digests 这张临时表，树本身不被改动
+    index = element._index
+    if index is not None:
+        return _digest(element, index.digests, index)
+    return _digest(element, {} if digests is None else digests)
+
+
+def _digest(element, digests, index=None):
+    # Merkle 式的摘要：元素的摘要由 tag、属性（不计顺序）和子节点（子元素用它们的摘要）算出。
+    # 结果存在 digests 里：id → (元素, 摘要)。index 不是 None 时 digests 是 index.digests，
+    # 元素（包括其中 Comment 的 text）被修改时与 to_str 的缓存一起沿 parents 作废
+    parents = index.parents if index is not None else None
+
+    def begin(e):
+        attrs = e._attrs
+        return ["Q" if isinstance(e, QMElement) else "E", e.tag, sorted(attrs.items()) if attrs else None]
+
+    entry = digests.get(id(element))
+    if entry is not None and entry[0] is element:
+        return entry[1]
+
+    stack = [(element, enumerate(_load(element) or ()), begin(element))]
+    while stack:
+        e, kids, fields = stack[-1]
+        for pos, _kid in kids:
+            if type(_kid) is str:
+                fields.append(_kid)
+            elif isinstance(_kid, Element):
+                if index is not None:
+                    if _kid._index is not index:
+                        _watch(_kid, index)
+                    parents[id(_kid)] = (_kid, e, pos)
+                entry = digests.get(id(_kid))
+                if entry is not None and entry[0] is _kid:
+                    fields.append(entry[1])
+                    continue
+                stack.append((_kid, enumerate(_load(_kid) or ()), begin(_kid)))
+                break
+            else:
+                if index is not None and isinstance(_kid, Comment):
+                    _kid._owner = e
+                fields.append(_kid_key(_kid, digests))
+        else:
+            stack.pop()
+            digest = _digest_fields(fields)
+            digests[id(e)] = (e, digest)
+            if not stack:
+                return digest
+            stack[-1][2].append(digest)
+
+
+def equal(a, b):
+    """
+    按结构比较两个元素：类型、tag、属性（不计顺序）、子节点都相同时为真，自闭合与否不算。
+    元素的 == 按对象身份；建立了索引的树会缓存摘要，反复比较时只重新计算修改过的部分
+    """
+    return _equal(a, b, {})
+
+
+def _equal(a, b, digests):
+    if a is b:
+        return True
+    if type(a) is not type(b) or a.tag != b.tag:
+        return False
+    return _element_digest(a, digests) == _element_digest(b, digests)
+
+
+def diff(a, b):
+    """
+    比较两棵树（Element 或 Xml），返回 [(路径, 变化, 旧, 新), ...]。摘要相同的子树直接跳过。
+    路径形如 'html/body[1]/p[2]'，[n] 是同名兄弟中的第几个。变化有：
+    "tag"：标签不同，旧、新是两个元素；"attrs"：属性不同，旧、新是两边的属性；
+    "removed"、"added"：只在一边出现的子节点，路径是父元素的路径
+    """
+    changes = []
+    # 没有索引的树，摘要在这次 diff 里共用
+    digests = {}
+    if isinstance(a, Xml) and isinstance(b, Xml):
+        stack = [("", a.kids, b.kids)]
+    elif isinstance(a, Element) and isinstance(b, Element):
+        if a.tag != b.tag or type(a) is not type(b):
+            return [(a.tag, "tag", a, b)]
+        stack = [(a.tag, a, b)]
+    else:
+        raise TypeError("diff() needs two Elements or two Xmls")
+
+    while stack:
+        path, x, y = stack.pop()
+        if isinstance(x, Element):
+            if _equal(x, y, digests):
+                continue
+            if (x._attrs or {}) != (y._attrs or {}):
+                changes.append((path, "attrs", dict(x._attrs or {}), dict(y._attrs or {})))
+            x_kids, y_kids = _load(x) or [], _load(y) or []
+        else:
+            x_kids, y_kids = x, y
+
+        x_names = _kid_names(path, x_kids)
+        matcher = _difflib.SequenceMatcher(None, [_kid_key(k, digests) for k in x_kids],
+                                           [_kid_key(k, digests) for k in y_kids], autojunk=False)
+        pending = []
+        for op, i1, i2, j1, j2 in matcher.get_opcodes():
+            if op == "equal":
+                continue
+            if op == "replace" and i2 - i1 == j2 - j1:
+                for i, j in zip(range(i1, i2), range(j1, j2)):
+                    x_kid, y_kid = x_kids[i], y_kids[j]
+                    if (isinstance(x_kid, Element) and type(x_kid) is type(y_kid) and x_kid.tag == y_kid.tag
+                            and not isinstance(x_kid, QMElement)):
+                        pending.append((x_names[i], x_kid, y_kid))
+                    else:
+                        changes.append((path, "removed", x_kid, None))
+                        changes.append((path, "added", None, y_kid))
+                continue
+            for i in range(i1, i2):
+                changes.append((path, "removed", x_kids[i], None))
+            for j in range(j1, j2):
+                changes.append((path, "added", None, y_kids[j]))
+        stack.extend(reversed(pending))
+
+    return changes
+
+
+def _kid_names(path, kids):
+    # 子元素的路径，其他子节点为 None
+    counts = {}
+    names = []
+    for _kid in kids:
+        if isinstance(_kid, Element) and not isinstance(_kid, QMElement):
+            n = counts[_kid.tag] = counts.get(_kid.tag, 0) + 1
+            names.append("{}/{}[{}]".format(path, _kid.tag, n) if path else _kid.tag)
+        else:
+            names.append(None)
+    return names
+
+
+def _find_value(nodes, attr_names, value):
+    for e in _iter_elements(nodes):
+        for name in attr_names:
+            if e._attrs and e._attrs.get(name) == value:
+                return e
+
+
+XML_NAMESPACE = "http://www.w3.org/XML/1998/namespace"
+XMLNS_NAMESPACE = "http://www.w3.org/2000/xmlns/"
+
+_default_nsmap = {"xml": XML_NAMESPACE, "xmlns": XMLNS_NAMESPACE}
+
+
+class Names(dict):
+    """
+    名字表。传给 parse、parse_bytes、iterparse、FeedParser 的 names 参数，同名的 tag、属性名共用表里的一个字符串；
+    同一个 Names 可以在多次解析之间共用。不传时每次解析用一个新表。
+    resolve 把 'prefix:local' 按 xmlns 声明解析成 (命名空间, 本地名)，同样的一对总是同一个元组，可以用 is 比较。
+    没有命名空间用 "" 表示。
+    """
+    __slots__ = ("_pairs",)
+
+    def __init__(self):
+        super().__init__()
+        self._pairs = {}
+
+    def __reduce__(self):
+        return Names, (), None, None, iter(self.items())
+
+    def intern(self, name):
+        return self.setdefault(name, name)
+
+    def pair(self, namespace, local):
+        key = (namespace or "", self.setdefault(local, local))
+        return self._pairs.setdefault(key, key)
+
+    def resolve(self, name, nsmap, is_attr=False):
+        # 没有前缀的属性不属于任何命名空间；前缀没有声明时，整个名字当作没有命名空间的本地名
+        prefix, sep, local = name.rpartition(":")
+        if sep:
+            namespace = nsmap.get(prefix)
+            if namespace is None:
+                return self.pair("", name)
+            return self.pair(namespace, local)
+        return self.pair("" if is_attr else nsmap.get(""), name)
+
+    def iter_resolved(self, nodes, nsmap=None):
+        """
+        先序遍历 nodes 中的元素及其后代，产生 (元素, (命名空间, 本地名), 元素处的前缀表)。
+        前缀表是 {前缀: 命名空间}，默认命名空间的前缀是 ""。nsmap 是祖先上的声明，nodes 不是整篇文档时用来补上
+        """
+        base = dict(_default_nsmap)
+        if nsmap:
+            base.update(nsmap)
+        # 前缀表只在有声明的元素处复制，同一个 tag 在同一张表下只解析一次。
+        # 表存在 resolved 里，不会被释放，id 不会重复
+        resolved = {}
+        resolve = self.resolve
+        for e, nsmap in _iter_nsmaps(nodes, base):
+            key = (e._tag, id(nsmap))
+            entry = resolved.get(key)
+            if entry is None:
+                entry = resolved[key] = (resolve(e._tag, nsmap), nsmap)
+            yield e, entry[0], nsmap
+
+
+def _declare(nsmap, attrs):
+    # attrs 里有 xmlns 声明时返回加上声明的新表，否则返回 nsmap 本身
+    declared = None
+    for k in attrs:
+        if k.startswith("xmlns") and (len(k) == 5 or k[5] == ":"):
+            if declared is None:
+                declared = dict(nsmap)
+            declared[k[6:]] = attrs[k]
+    return nsmap if declared is None else declared
+
+
+def _iter_nsmaps(nodes, nsmap):
+    # 先序产生 (元素, 元素处的前缀表)，不递归
+    stack = [(x, nsmap) for x in reversed(nodes) if isinstance(x, Element)]
+    while stack:
+        e, nsmap = stack.pop()
+        if e._attrs:
+            nsmap = _declare(nsmap, e._attrs)
+        yield e, nsmap
+        if _load(e):
+            stack.extend((x, nsmap) for x in reversed(e._kids) if isinstance(x, Element))
+
+
+def _inherited_nsmap(element):
+    # element 的祖先上的声明；祖先要靠 track_parents 才知道，没有跟踪时 iter_ancestors 抛出 ValueError
+    nsmap = dict(_default_nsmap)
+    for e in reversed(list(element.iter_ancestors())):
+        if e._attrs:
+            nsmap = _declare(nsmap, e._attrs)
+    return nsmap
+
+
+def _find_all_ns(nodes, tag, namespace, nsmap, strict=False):
+    # 没有索引时每次走一遍，只有本地名对得上的元素才解析前缀。
+    # strict 时 nsmap 之外还可能有不知道的祖先声明，用到子树里没有声明的前缀（包括默认命名空间）就抛出 ValueError
+    names = Names()
+    target = names.pair(namespace, tag)
+    suffix = ":" + tag
+    found = []
+    for e, nsmap in _iter_nsmaps(nodes, nsmap):
+        if e._tag == tag or e._tag.endswith(suffix):
+            if strict and e._tag.rpartition(":")[0] not in nsmap:
+                raise ValueError("{!r} depends on namespace declarations of the ancestors, "
+                                 "call track_parents() or pass nsmap".format(e._tag))
+            if names.resolve(e._tag, nsmap) is target:
+                found.append(e)
+    return found
+
+
+def _group_by_name(nodes, nsmap):
+    # {(命名空间, 本地名): [元素, ...]}，文档顺序
+    groups = {}
+    for e, qname, _ in Names().iter_resolved(nodes, nsmap):
+        groups.setdefault(qname, []).append(e)
+    return groups
+
+
 class Element(_Node):
+    # attrs、kids 为空时不分配 dict、list，第一次访问 .attrs、.kids 时才建立
+    __slots__ = ("_tag", "_attrs", "_kids", "_self_closing", "_index")
+
     def __init__(self, tag=None, attrs=None, kids=None):
-        _Node.__init__(self)
-        self.tag = tag
-        self._attrs = dict(attrs) if attrs else {}
-        self._kids = list(kids) if kids else []
+        if not isinstance(tag, str):
+            raise ValueError
+        self._tag = tag
+        self._attrs = _new_attrs(self, attrs) if attrs else None
+        self._kids = _new_kids(self, kids) if kids else None
+        self._index = None
 
         # 通过 Element() 建立的节点，默认设置为自闭合标签
-        self.self_closing = True
+        self._self_closing = True
+
+    def __getstate__(self):
+        # 复制、pickle 时不带索引：索引引用着整篇文档，带上它一个元素会拖着整棵树。
+        # 惰性解析的 kids 先解析出来，_Pending 同样引用着整篇文本
+        _load(self)
+        state = {name: getattr(self, name) for name in Element.__slots__}
+        state["_index"] = None
+        return getattr(self, "__dict__", None), state
 
     @property
     def tag(self):
@@ -121,26 +904,51 @@ class Element(_Node):
         if not isinstance(value, str):
             raise ValueError
         self._tag = value
+        if self._index is not None:
+            # 父节点按 tag 分好的子元素也跟着变了
+            self._index.kids.clear()
+        self._changed()
 
     @property
     def attrs(self):
-        return self._attrs
+        # 第一次访问时换成 _Attrs，之后总是同一个对象
+        attrs = self._attrs
+        if type(attrs) is not _Attrs:
+            attrs = self._attrs = _new_attrs(self, attrs or ())
+        return attrs
 
     @attrs.setter
     def attrs(self, value):
-        if not isinstance(dict, value):
+        # 存的是 value 的副本
+        if not isinstance(value, dict):
             raise ValueError
-        self._attrs = value
+        self._attrs = _new_attrs(self, value)
+        self._changed()
 
     @property
     def kids(self):
-        return self._kids
+        # 第一次访问时换成 _Kids，之后总是同一个对象
+        kids = self._kids
+        if type(kids) is not _Kids:
+            kids = self._kids = _new_kids(self, _load(self) or ())
+        return kids
 
     @kids.setter
     def kids(self, value):
+        # 存的是 value 的副本
         if not isinstance(value, list):
             raise ValueError
-        self._kids = value
+        index = self._index
+        self._kids = _new_kids(self, value)
+        if index is not None and index.dirty is not None:
+            index.adopt(self, value)
+        self._changed()
+        if index is not None:
+            index.removed()
+
+    def _changed(self):
+        if self._index is not None:
+            self._index.changed(self)
 
     @property
     def self_closing(self):
@@ -151,6 +959,7 @@ class Element(_Node):
         if not isinstance(value, bool):
             raise Exception
         self._self_closing = value
+        self._changed()
 
     def ekid(self, *args, **kwargs):
         e = Element(*args, **kwargs)
@@ -166,117 +975,268 @@ class Element(_Node):
         self.kids.append(c)
         return c
 
+    def extend_kids(self, specs, validate=True):
+        # 一次加入多个子节点，每项的格式同 build；kids 只修改一次，建立了索引的树也只通知一次
+        created = [] if validate else None
+        kids = _build(specs, created)
+        if validate:
+            _check_elements(created)
+        self.kids.extend(kids)
+        return kids
+
     def to_str(self,
                do_pretty=False,
                begin_indent=0,
                step=4,
                char=" ",
                dont_do_tags=None,
-               self_closing=True
+               self_closing=True,
+               stats=None
                ):
+        if stats is not None:
+            return stats._to_str(self, self.iter_str(do_pretty, begin_indent, step, char, dont_do_tags, self_closing))
+        return "".join(self.iter_str(do_pretty, begin_indent, step, char, dont_do_tags, self_closing))
 
-        dont_do_tags = dont_do_tags or []
-
-        s = '<'
+    def _iter_begin(self, self_closing):
+        # 开始标签；没有子节点时连同结尾一起返回，否则返回 None 表示还需要写子节点
         assert self.tag
-        s += self.tag
+        s = '<' + self.tag
 
-        _attrs_string_list = []
-        for attr_name, attr_value in self.attrs.items():
-            _attrs_string_list.append('{}="{}"'.format(attr_name, _escape(attr_value, _xml_attr_escape_table)))
+        if self._attrs:
+            s += ' ' + ' '.join('{}="{}"'.format(attr_name, _escape(attr_value, _xml_attr_escape_table))
+                                for attr_name, attr_value in self._attrs.items())
 
-        if _attrs_string_list:
-            s += ' '
-            s += ' '.join(_attrs_string_list)
+        if _load(self):
+            return s + '>', False
 
-        if self._kids:
-            s += '>'
+        if self_closing is True:
+            self_closing_ultimately = True
+        elif self_closing is False:
+            self_closing_ultimately = False
+        elif self_closing is None:
+            self_closing_ultimately = self.self_closing
+        else:
+            raise Exception("HOW?")
+
+        if self_closing_ultimately is True:
+            return s + '/>', True
+        elif self_closing_ultimately is False:
+            return s + '></{}>'.format(self.tag), True
+        else:
+            raise Exception("HOW?")
+
+    def iter_str(self,
+                 do_pretty=False,
+                 begin_indent=0,
+                 step=4,
+                 char=" ",
+                 dont_do_tags=None,
+                 self_closing=True
+                 ):
+        # 与 to_str 输出相同，但一段一段地产生；用显式的栈代替递归
+        dont_do_tags = dont_do_tags or []
 
-            _indent_text = '\n' + char * (begin_indent + step)
-            do_pretty_ultimately = do_pretty and self.tag not in dont_do_tags and self not in dont_do_tags
-            for _kid in self._kids:
-                if do_pretty_ultimately:
-                    s += _indent_text
+        if self._index is not None and self._index.renders is not None:
+            yield _render_cached(self, self._index, do_pretty, begin_indent, step, char, dont_do_tags, self_closing)
+            return
+
+        s, done = self._iter_begin(self_closing)
+        yield s
+        if done:
+            return
+
+        # dont_do_tags 里也可以放元素本身；单独挑出来，免得每个元素都要和每个 tag 字符串比较
+        dont_do_elements = [x for x in dont_do_tags if isinstance(x, Element)]
+
+        do_pretty_ultimately = do_pretty and self.tag not in dont_do_tags and self not in dont_do_elements
+        stack = [(self, iter(self._kids), do_pretty_ultimately, begin_indent)]
+        while stack:
+            element, kids, do_pretty, begin_indent = stack[-1]
+            for _kid in kids:
+                if do_pretty:
+                    yield '\n' + char * (begin_indent + step)
 
                 if isinstance(_kid, str):
-                    s += _escape_element_string(_kid)
+                    yield _escape_element_string(_kid)
 
                 elif isinstance(_kid, Element):
-                    s += _kid.to_str(do_pretty_ultimately,
-                                     begin_indent + step,
-                                     step,
-                                     char,
-                                     dont_do_tags,
-                                     self_closing
-                                     )
+                    if type(_kid).to_str is not Element.to_str:
+                        # QMElement 等子类有自己的 to_str
+                        yield _kid.to_str(do_pretty=do_pretty,
+                                          begin_indent=begin_indent + step,
+                                          step=step,
+                                          char=char,
+                                          dont_do_tags=dont_do_tags,
+                                          self_closing=self_closing)
+                        continue
+
+                    s, done = _kid._iter_begin(self_closing)
+                    yield s
+                    if not done:
+                        do_pretty_ultimately = do_pretty and _kid.tag not in dont_do_tags and _kid not in dont_do_elements
+                        stack.append((_kid, iter(_kid._kids), do_pretty_ultimately, begin_indent + step))
+                        break
+
                 elif isinstance(_kid, Comment):
-                    s += _kid.to_str()
+                    yield _kid.to_str()
                 else:
                     raise TypeError("Kid type:{} not supported by to_str().".format(type(_kid)))
-            if do_pretty_ultimately:
-                s += '\n' + char * begin_indent
-
-            s += '</{}>'.format(self.tag)
-
-        else:
-            if self_closing is True:
-                self_closing_ultimately = True
-            elif self_closing is False:
-                self_closing_ultimately = False
-            elif self_closing is None:
-                self_closing_ultimately = self.self_closing
             else:
-                raise Exception("HOW?")
-
-            if self_closing_ultimately is True:
-                s += '/>'
-            elif self_closing_ultimately is False:
-                s = s + ">" + '</{}>'.format(self.tag)
-            else:
-                raise Exception("HOW?")
-
-        return s
+                stack.pop()
+                if do_pretty:
+                    yield '\n' + char * begin_indent
+                yield '</{}>'.format(element.tag)
+
+    def itertext(self, skip_tags=None, with_tail_separators=False):
+        """
+        依次产生自己和后代的文本，跳过注释。skip_tags 是一个 tag、一组 tag 或 f(tag, attrs)，选中的元素连同子树跳过。
+        with_tail_separators 为真时，元素（包括被跳过的元素）之后还有文本的话，先产生一个分隔符，
+        免得前后两段文本粘在一起；默认是 "\n"，也可以直接给一个字符串
+        """
+        return _itertext(self, _selector(skip_tags), _tail_separator(with_tail_separators))
+
+    def text_content(self, skip_tags=None, with_tail_separators=False):
+        return "".join(self.itertext(skip_tags, with_tail_separators))
 
     def find_attr(self, attr):
-        for _attr, value in self.attrs.items():
-            if _attr == attr:
-                return value
-
-    def find_all(self, tag):
-        es = []
-        if self.tag == tag:
-            es.append(self)
-        for _kid in self.kids:
-            if isinstance(_kid, Element):
-                es.extend(_kid.find_all(tag))
-        return es
+        if self._attrs:
+            return self._attrs.get(attr)
+
+    def find_all(self, tag, namespace=None, nsmap=None):
+        # 指定 namespace 时按 (命名空间, 本地名) 查找，祖先上的 xmlns 声明也算：nsmap 是 {前缀: 命名空间}，
+        # 给出时就当作祖先上的声明，否则跟踪了父节点时从祖先算出来。两者都没有时，
+        # 只有对得上的元素用到了子树里没有声明的前缀才抛出 ValueError。有索引时结果按子树缓存在索引里
+        if namespace is not None:
+            index = self._index
+            if nsmap is not None:
+                nsmap = dict(_default_nsmap, **nsmap)
+            elif index is not None and index.dirty is not None:
+                nsmap = _inherited_nsmap(self)
+            else:
+                return _find_all_ns([self], tag, namespace, _default_nsmap, strict=True)
+            if index is not None:
+                return index.find_all_ns(self, tag, namespace, nsmap)
+            return _find_all_ns([self], tag, namespace, nsmap)
+        if self._index is not None and self._index.owner is self:
+            return self._index.find_all(tag)
+        return [e for e in _iter_elements([self]) if e.tag == tag]
+
+    def find_id(self, value, attrs=("id", "xml:id")):
+        if self._index is not None and self._index.owner is self and self._index.attr_names == tuple(attrs):
+            return self._index.find_value(value)
+        return _find_value([self], attrs, value)
+
+    def iter_find(self, path):
+        # 惰性地逐个产生匹配 path 的元素，例如 'body/p[@class="x"]//a'
+        return _compile_query(path).select([self])
+
+    def find(self, path):
+        return next(self.iter_find(path), None)
 
     def find_kids(self, tag):
+        if self._index is not None:
+            return self._index.find_kids(self, tag)
         kids = []
-        for _kid in self.kids:
+        for _kid in _load(self) or ():
             if isinstance(_kid, Element) and _kid.tag == tag:
                 kids.append(_kid)
         return kids
 
+    def clear(self):
+        # 原地清空，正在解析中的 iterparse 仍持有同一个 kids 列表。
+        # 元素本身不会离开父元素的 kids，要释放它得从父元素上摘掉（见 iterparse）
+        if type(self._kids) is _Pending:
+            self._kids = None
+        if self._kids:
+            del self._kids[:]
+        if self._attrs:
+            self._attrs.clear()
+
+    def build_index(self, attrs=("id", "xml:id")):
+        # 建立 tag 与属性值（默认 id、xml:id）的索引，之后的 find_all、find_id、find_kids 只花 O(结果) 的时间
+        return _build_index(self, attrs)
+
+    def track_parents(self):
+        # 记下整棵树里每个元素的父元素和位置，之后经由 kids 的修改保持最新。
+        # 不需要 parent 等属性时不必调用，省下每个元素一项记录的内存
+        return _track_parents(self)
+
+    def _locate(self):
+        index = self._index
+        if index is None or index.dirty is None:
+            raise ValueError("Parent tracking is off for this tree, call track_parents() first")
+        place = index.locate(self)
+        if place is None or not isinstance(place[0], Element):
+            return None
+        return place
+
+    @property
+    def parent(self):
+        place = self._locate()
+        return place[0] if place is not None else None
+
+    @property
+    def index_in_parent(self):
+        place = self._locate()
+        return place[1] if place is not None else None
+
+    @property
+    def next(self):
+        # 后一个兄弟节点，可能是字符串或 Comment
+        place = self._locate()
+        if place is not None:
+            kids = place[0]._kids
+            if place[1] + 1 < len(kids):
+                return kids[place[1] + 1]
+
+    @property
+    def previous(self):
+        place = self._locate()
+        if place is not None and place[1] > 0:
+            return place[0]._kids[place[1] - 1]
+
+    def iter_ancestors(self):
+        e = self.parent
+        while e is not None:
+            yield e
+            e = e.parent
+
+    def build_str_cache(self):
+        # 之后的 to_str 记住每个有子节点的元素的输出，只重新输出修改过的元素和它们的祖先
+        return _build_str_cache(self)
+
+    def digest(self):
+        # 子树的摘要（bytes），tag、属性、子节点都相同的子树摘要相同。自闭合与否不算。
+        # 建立了索引（build_index、track_parents、build_str_cache）的树缓存摘要，之后只重新计算修改过的元素和它们的祖先；
+        # 没有索引时每次从头计算，不改动树
+        return _element_digest(self, None)
+
 
 # question mark element
 class QMElement(Element):
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
     def to_str(self, *args, **kwargs):
         kwargs["self_closing"] = True
-        s = super().to_str(*args, **kwargs)
+        s = "".join(super().iter_str(*args, **kwargs))
         assert s[-2:] == "/>"
         new_s = "<?" + s[1:-2] + "?>"
         return new_s
 
+    def iter_str(self, *args, **kwargs):
+        yield self.to_str(*args, **kwargs)
+
     @property
     def kids(self):
         return []
 
 
 class Prolog(QMElement):
+    __slots__ = ()
+
     def __init__(self, version=None, encoding=None, standalone=None):
         super().__init__(tag="xml")
         self.version = version or '1.0'
@@ -311,11 +1271,28 @@ class Prolog(QMElement):
             self.attrs["standalone"] = value
 
 
-class Comment(object):
+class Comment(_Node):
+    # _owner 是上次缓存输出时所在的元素（见 _render_cached），修改 text 时通知它
+    __slots__ = ("_text", "_owner")
+
     def __init__(self, text):
-        self.text = text
+        self._text = text
+        self._owner = None
 
-    def to_str(self):
+    def __getstate__(self):
+        return None, {"_text": self._text, "_owner": None}
+
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        self._text = value
+        if self._owner is not None:
+            self._owner._changed()
+
+    def to_str(self, *args, **kwargs):
         return "<!--{}-->".format(_escape_comment(self.text))
 
 
@@ -324,6 +1301,55 @@ def _escape_comment(text):
     return text
 
 
+def _make_element(tag, attrs, self_closing):
+    # 解析器用的快速构造，跳过 __init__ 里的检查
+    e = _new_element(Element)
+    e._tag = tag
+    e._attrs = attrs
+    e._kids = None
+    e._self_closing = self_closing
+    e._index = None
+    return e
+
+
+_new_element = object.__new__
+
+
+class _Layout(object):
+    # 惰性解析时一次扫描记下的元素位置，按文档顺序排列，每个元素占各数组的一项：
+    # starts 开始标签的 '<'，content_ends 结束标签的 '<'（自闭合为 -1），ends 元素之后的位置，sizes 后代元素个数
+    __slots__ = ("text", "starts", "content_ends", "ends", "sizes", "space", "ignore_comment", "names")
+
+    def __init__(self, text, space, ignore_comment, names):
+        typecode = "i" if len(text) < 2 ** 31 else "q"
+        self.text = text
+        self.starts = _array(typecode)
+        self.content_ends = _array(typecode)
+        self.ends = _array(typecode)
+        self.sizes = _array(typecode)
+        self.space = space
+        self.ignore_comment = ignore_comment
+        self.names = names
+
+
+class _Pending(object):
+    # 惰性解析：元素的 _kids 暂时是它在 _Layout 中的位置，第一次访问时才解析。xml_space 是从祖先继承的 xml:space
+    __slots__ = ("layout", "index", "begin", "xml_space")
+
+    def __init__(self, layout, index, begin, xml_space):
+        self.layout = layout
+        self.index = index
+        self.begin = begin
+        self.xml_space = xml_space
+
+
+def _load(node):
+    kids = node._kids
+    if type(kids) is _Pending:
+        kids = node._kids = _parse_pending(node, kids)
+    return kids
+
+
 def skid(element, tag, attrs=None, kids=None):
     sub_element = Element(tag, attrs, kids)
     element.kids.append(sub_element)
@@ -334,6 +1360,151 @@ def sub(*args, **kwargs):
     return skid(*args, **kwargs)
 
 
+def _build(specs, created=None):
+    # 按 build 的格式把 specs 变成节点列表。跳过 Element() 的检查和属性访问，不递归：
+    # 待填 kids 的元素放在 todo 里，各自按顺序填，先后无所谓。
+    # created 不是 None 时，新建的元素都放进去，留给 _check_elements 统一检查；其他类型的子节点当场检查
+    new = _new_element
+    validate = created is not None
+    nodes = []
+    todo = [(specs, 0, nodes)]
+    push = todo.append
+    pop = todo.pop
+    while todo:
+        spec, n, out = pop()
+        add = out.append
+        for i in range(n, len(spec)):
+            kid = spec[i]
+            if type(kid) is not tuple and type(kid) is not list:
+                if validate and type(kid) is not str and not isinstance(kid, (Element, Comment)):
+                    raise TypeError("Kid type:{} not supported by build().".format(type(kid)))
+                add(kid)
+                continue
+            e = new(Element)
+            e._tag = kid[0]
+            e._index = None
+            e._self_closing = True
+            m = 1
+            if len(kid) > 1:
+                attrs = kid[1]
+                if type(attrs) is dict:
+                    e._attrs = attrs.copy() if attrs else None
+                    m = 2
+                elif attrs is None:
+                    e._attrs = None
+                    m = 2
+                else:
+                    e._attrs = None
+            else:
+                e._attrs = None
+            if len(kid) == m:
+                e._kids = None
+            elif len(kid) == m + 1 and type(kid[m]) is str:
+                # 只有一段文本的元素最常见，不必进 todo
+                e._kids = [kid[m]]
+            else:
+                e._kids = []
+                push((kid, m, e._kids))
+            add(e)
+            if validate:
+                created.append(e)
+    return nodes
+
+
+def _check_elements(elements):
+    for e in elements:
+        tag = e._tag
+        if type(tag) is not str or not tag:
+            raise ValueError("Bad tag: {}".format(repr(tag)))
+        attrs = e._attrs
+        if attrs:
+            for key, value in attrs.items():
+                if type(key) is not str or type(value) is not str:
+                    raise ValueError("Bad attribute of {}: {}={}".format(repr(tag), repr(key), repr(value)))
+
+
+def build(spec, validate=True):
+    """
+    一次调用建立整棵子树。spec 是 (tag, kid, ...) 或 (tag, attrs, kid, ...) 形式的 tuple 或 list，attrs 是 dict 或 None；
+    kid 是字符串、Comment、Element，或者同样格式的 tuple、list。例如
+        build(("p", {"id": "1"}, "如是", ("b", "我聞"), ("lb",)))
+    建好之后统一检查一次 tag、属性和子节点的类型；validate=False 时不检查。
+    一次建立上百万个节点时，分代垃圾回收会占去相当一部分时间，需要的话调用者可以自己临时 gc.disable()。
+    """
+    created = [] if validate else None
+    e, = _build([spec], created)
+    if not isinstance(e, Element):
+        raise TypeError("build() needs a tuple or list, got: {}".format(type(spec)))
+    if validate:
+        _check_elements(created)
+    return e
+
+
+class ElementMaker(object):
+    """
+    E.p({"id": "1"}, "如是", E.b("我聞")) 建立 <p id="1">如是<b>我聞</b></p>。
+    tag 不能写成 Python 名字时用 E("cb:div", ...)。kid 也可以是 build 格式的 tuple、list
+    """
+    def __init__(self, validate=True):
+        self._validate = validate
+        self._makers = {}
+
+    def __call__(self, tag, *kids):
+        maker = self._makers.get(tag)
+        if maker is None:
+            maker = self._maker(tag)
+        return maker(*kids)
+
+    def __getattr__(self, tag):
+        if tag.startswith("__"):
+            raise AttributeError(tag)
+        # 存成实例属性，下次不再经过 __getattr__
+        maker = self._maker(tag)
+        setattr(self, tag, maker)
+        return maker
+
+    def _maker(self, tag):
+        # 每个 tag 一个闭包，tag 只检查一次；常见的子节点全是字符串、Element 时不经过 _build
+        validate = self._validate
+        if validate and (type(tag) is not str or not tag):
+            raise ValueError("Bad tag: {}".format(repr(tag)))
+        new = _new_element
+
+        def make(*kids):
+            e = new(Element)
+            e._tag = tag
+            e._attrs = None
+            e._self_closing = True
+            e._index = None
+            if not kids:
+                e._kids = None
+                return e
+            attrs = kids[0]
+            if type(attrs) is dict or attrs is None:
+                kids = kids[1:]
+                if attrs:
+                    e._attrs = attrs.copy()
+                    if validate:
+                        for key, value in attrs.items():
+                            if type(key) is not str or type(value) is not str:
+                                _check_elements((e,))
+            for kid in kids:
+                if type(kid) is not str and type(kid) is not Element:
+                    created = [] if validate else None
+                    e._kids = _build(kids, created)
+                    if created:
+                        _check_elements(created)
+                    return e
+            e._kids = [*kids] if kids else None
+            return e
+
+        self._makers[tag] = make
+        return make
+
+
+E = ElementMaker()
+
+
 def _parse_prolog(text, i):
     if text[i] != "<":
         return False, None
@@ -371,62 +1542,55 @@ def _parse_prolog(text, i):
     return True, (element, i)
 
 
+_angle_re = _re.compile("[<>]")
+
+
 def _parse_doctype(text, i):
     if text[i:i + 10] != "<!DOCTYPE ":
         return False, None
     i += 10
-    _text = ""
 
     lessthan = 0
     greaterthan = 0
-    while i < len(text):
-        if text[i] == ">":
+    j = len(text)
+    for m in _angle_re.finditer(text, i):
+        if m.group() == ">":
             greaterthan += 1
-        elif text[i] == "<":
+        else:
             lessthan += 1
 
         if greaterthan - lessthan == 1:
+            j = m.start()
             break
-        else:
-            _text += text[i]
-            i += 1
 
-    i += 1
-    return True, (DocType(_text), i)
+    return True, (DocType(text[i:j]), j + 1)
 
 
 _blank = (" ", "\t", "\n", "\r")
 
 
+_blank_re = _re.compile("[ \t\n\r]*")
+_tag_re = _re.compile("[^ />]*")
+_endtag_re = _re.compile("[^ >]*")
+
+
 def _ignore_blank(text, i):
-    while i < len(text):
-        if text[i] not in _blank:
-            return i
-        else:
-            i += 1
-    return i
+    return _blank_re.match(text, i).end()
 
 
 def _read_tag(text, i):
-    tag = ""
-    while i < len(text) and text[i] not in " />":
-        tag += text[i]
-        i += 1
-    return tag, i
+    m = _tag_re.match(text, i)
+    return m.group(), m.end()
 
 
 def _read_endtag(text, i):
-    tag = ""
-    while i < len(text) and text[i] not in " >":
-        tag += text[i]
-        i += 1
-    return tag, i
+    m = _endtag_re.match(text, i)
+    return m.group(), m.end()
 
 
 def _parse_string(text, i) -> tuple:
     s, i = _read_text(text, i)
     if s:
-        # return True, (_unescape(s, _xml_escape_table), i)
         return True, (_unescape_element_string(s), i)
     else:
         return False, None
@@ -440,53 +1604,116 @@ _element_string_table = (
 
 
 def _unescape_element_string(text):
-    table = (
-        ('&', '&amp;'),  # I guess this must be the first one?
-        ('<', '&lt;'),
-        ('>', '&gt;')
-    )
-    return _unescape(text, table)
+    return _unescape(text)
 
 
 def _escape_element_string(text):
-    table = (
-        ('&', '&amp;'),  # I guess this must be the first one?
-        ('<', '&lt;'),
-        ('>', '&gt;')
-    )
-    return _escape(text, table)
+    return _escape(text, _element_string_table)
 
 
 def _read_text(text, i):
-    t = ""
-    while i < len(text) and text[i] not in "<":
-        t += text[i]
-        i += 1
-    return t, i
+    j = text.find("<", i)
+    if j == -1:
+        j = max(i, len(text))
+    return text[i:j], j
+
+
+_PRESERVE = "preserve"
+_STRIP = "strip"
+_COLLAPSE = "collapse"
+
+_collapse_re = _re.compile("[ \t\n\r]+")
+_nonblank_re = _re.compile("[^ \t\n\r]")
+
+
+def _whitespace_mode(name):
+    for mode in (_PRESERVE, _STRIP, _COLLAPSE):
+        if name == mode:
+            return mode
+    raise ValueError("Unknown whitespace mode: {}".format(repr(name)))
+
+
+class _Whitespace(object):
+    # parse 的 whitespace 参数：一个处理方式，或者 {tag: 处理方式}，键 None 表示其他元素。
+    # 处理方式有 "preserve"（原样保留）、"strip"（去掉两端的空白，只有空白的文本丢掉）、
+    # "collapse"（连续的空白换成一个空格，只有空白的文本变成 " "）。
+    # 默认是 "strip"，do_strip=False 时是 "preserve"；dont_do_tags 里的 tag 保留空白。
+    # xml:space="preserve" 对元素及其后代有效，直到 xml:space="default"
+    __slots__ = ("default", "tags")
+
+    def __init__(self, whitespace=None, do_strip=None, dont_do_tags=None):
+        self.default = _PRESERVE if do_strip is False else _STRIP
+        self.tags = dict.fromkeys(dont_do_tags or (), _PRESERVE)
+        if isinstance(whitespace, str):
+            self.default = _whitespace_mode(whitespace)
+        elif whitespace:
+            for tag, mode in whitespace.items():
+                if tag is None:
+                    self.default = _whitespace_mode(mode)
+                else:
+                    self.tags[tag] = _whitespace_mode(mode)
+
+    def mode(self, tag, attrs, space):
+        # 返回 (元素自己的文本的处理方式, 子元素继承的 xml:space)
+        if attrs:
+            space = attrs.get("xml:space", space)
+        if space == _PRESERVE:
+            return _PRESERVE, space
+        return self.tags.get(tag, self.default), space
+
+
+def _text_node(text, i, j, mode):
+    # text[i:j] 是两个标签之间的一段文本，按处理方式 mode 变成字符串。
+    # 可以忽略的空白在切片之前就判断出来，返回 None，不建立任何对象
+    if i == j:
+        return None
+    if mode is _PRESERVE:
+        return _unescape_element_string(text[i:j])
+    # 大多数文本不以空白开头，不用查找；只有空白时 search 返回 None，也不产生 Match
+    if text[i] in _blank:
+        m = _nonblank_re.search(text, i, j)
+        if m is None:
+            return None if mode is _STRIP else " "
+        k = m.start()
+    else:
+        k = i
+    if mode is _STRIP:
+        return _unescape_element_string(text[k:j]).strip() or None
+    return _unescape_element_string(_collapse_re.sub(" ", text[i:j]))
 
 
 #  ↑↓←→↖↗↙↘
-def _parse_element(text, i, do_strip=False, dont_do_tags=None, ignore_comment=True):
-    dont_do_tags = dont_do_tags or []
+def _parse_start_tag(text, i, names=None):
+    result = _read_start_tag(text, i, names)
+    if result is None:
+        return False, None
+    tag, attrs, i, closed = result
+    return True, (_make_element(tag, attrs, closed), i, closed)
+
 
+def _read_start_tag(text, i, names=None):
+    # 读开始标签，不建立 Element，返回 (tag, attrs, 之后的位置, 是否自闭合)，失败时返回 None。
+    # names 是名字表（dict 或 Names），tag 和属性名换成表里的同一个字符串对象
     # <a id="1">xx<b/>yy</a>
     # ↑           ↑
     if text[i] != "<":
-        return False, None
+        return None
 
     i = _ignore_blank(text, i + 1)
 
-    if text[i] == "!":
-        return False, None
+    if text[i:i + 1] == "!":
+        return None
 
     # <a level="1"></a>
     # <a level="1" />
 
     tag, i = _read_tag(text, i)
     if not tag:
-        return False, None
+        return None
+    if names is not None:
+        tag = names.setdefault(tag, tag)
 
-    e = Element(tag=tag)
+    attrs = None
     i = _ignore_blank(text, i)
 
     # 读取属性
@@ -494,41 +1721,37 @@ def _parse_element(text, i, do_strip=False, dont_do_tags=None, ignore_comment=Tr
         # <a id="1">xx<b/>yy</a>
         #          ↖
         key, value, i = _read_attr(text, i)
-        e.attrs[key] = value
+        if names is not None:
+            key = names.setdefault(key, key)
+        if attrs is None:
+            attrs = {}
+        attrs[key] = value
         i = _ignore_blank(text, i)
 
     # />
     # 自封闭标签，到此结束
-    if text[i] == "/":
+    if text[i:i + 1] == "/":
         # <a id="1">xx<b/>yy</a>
         #               ↑
         i += 1
         i = _ignore_blank(text, i)
-        if text[i] != ">":
-            return False, None
+        if text[i:i + 1] != ">":
+            return None
         i += 1
-        i = _ignore_blank(text, i)
-        e.self_closing = True
-        return True, (e, i)
+        return tag, attrs, i, True
     # >
     # 非自封闭标签，继续读取子元素
-    elif text[i] == ">":
+    elif text[i:i + 1] == ">":
         # <a id="1">xx<b/>yy</a>
         #          ↑
         i += 1
+        return tag, attrs, i, False
 
     else:
-        raise Exception
-    #######
+        return None
 
-    _kids, i = _read_subs(text, i, do_strip=do_strip, dont_do_tags=dont_do_tags, ignore_comment=ignore_comment)
-    for x in _kids:
-        x2 = x
-        if isinstance(x, str) and tag not in dont_do_tags:
-            x2 = x.strip()
-        if x2:
-            e.kids.append(x2)
 
+def _parse_end_tag(text, i, tag):
     # </a>
     # kids 读完了，该读取结尾了，结尾必然是这种格式：</a>
     if text[i] != "<":
@@ -536,7 +1759,7 @@ def _parse_element(text, i, do_strip=False, dont_do_tags=None, ignore_comment=Tr
     i += 1
 
     i = _ignore_blank(text, i)
-    if text[i] != "/":
+    if text[i:i + 1] != "/":
         return False, None
     i += 1
 
@@ -546,13 +1769,230 @@ def _parse_element(text, i, do_strip=False, dont_do_tags=None, ignore_comment=Tr
     i += len(tag)
 
     i = _ignore_blank(text, i)
-    if text[i] != ">":
+    if text[i:i + 1] != ">":
         return False, None
     i += 1
-    e.self_closing = False
+    return True, i
+
+
+def _parse_markup(text, i):
+    # 问号元素、DOCTYPE 和注释都不会嵌套，可以一次读完
+    c = text[i + 1:i + 2]
+    if c == "!":
+        is_success, result = _parse_doctype(text, i)
+        if is_success:
+            return is_success, result
+        return _parse_comment(text, i)
+    elif c == "?" or c in _blank:
+        return _parse_prolog(text, i)
+    return False, None
+
+
+def _parse_element(text, i, do_strip=None, dont_do_tags=None, ignore_comment=True, names=None, whitespace=None):
+    space = whitespace if type(whitespace) is _Whitespace else _Whitespace(whitespace, do_strip, dont_do_tags)
+
+    is_success, result = _parse_start_tag(text, i, names)
+    if not is_success:
+        return False, None
+
+    e, i, closed = result
+    if closed:
+        return True, (e, i)
+
+    is_success, i = _parse_content(text, i, e, space, ignore_comment, names)
+    if not is_success:
+        return False, None
     return True, (e, i)
 
-    #######
+
+def _parse_content(text, i, element, space, ignore_comment, names=None):
+    # 读取 element 的开始标签之后的全部内容，直到它的结束标签。
+    # 尚未闭合的元素放在显式的栈里，而不是递归调用，嵌套再深也不会 RecursionError。
+    # space 是 _Whitespace，xml_space 是从祖先继承的 xml:space
+    length = len(text)
+    stack = []
+    kids = _kids_of(element)
+    mode, xml_space = space.mode(element._tag, element._attrs, None)
+
+    while i < length:
+        if text[i] != "<":
+            j = text.find("<", i)
+            if j == -1:
+                j = length
+            s = _text_node(text, i, j, mode)
+            if s is not None:
+                kids.append(s)
+            i = j
+            continue
+
+        if text[i + 1:i + 2] != "/":
+            is_success, result = _parse_markup(text, i)
+            if is_success:
+                term, i = result
+                if not (ignore_comment and type(term) is Comment):
+                    kids.append(term)
+                continue
+
+            is_success, result = _parse_start_tag(text, i, names)
+            if is_success:
+                e, i, closed = result
+                kids.append(e)
+                if not closed:
+                    stack.append((element, kids, mode, xml_space))
+                    element = e
+                    kids = _kids_of(e)
+                    mode, xml_space = space.mode(e._tag, e._attrs, xml_space)
+                continue
+
+        is_success, i = _parse_end_tag(text, i, element.tag)
+        if not is_success:
+            return False, None
+        element._self_closing = False
+        if not kids:
+            element._kids = None
+
+        if not stack:
+            return True, i
+        element, kids, mode, xml_space = stack.pop()
+
+    return False, None
+
+
+_layout_re = _re.compile(r"""<(?:
+    !--.*?-->
+  | (!)
+  | [ \t\n\r]*(?:
+        (/)[ \t\n\r]*([^ \t\n\r>]*)[ \t\n\r]*>
+      | (\?)[^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*>
+      | ([^ />]*)[^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*>
+    ))""", _re.DOTALL | _re.VERBOSE)
+
+
+def _scan_layout(text, i, layout):
+    # 从 text[i] 处的开始标签起，只数标签，记下整棵子树每个元素的位置，不建立任何节点。
+    # 返回元素之后的位置
+    starts = layout.starts
+    content_ends = layout.content_ends
+    ends = layout.ends
+    sizes = layout.sizes
+    search = _layout_re.search
+    add_start = starts.append
+    add_content_end = content_ends.append
+    add_end = ends.append
+    add_size = sizes.append
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    while True:
+        m = search(text, i)
+        if m is None:
+            raise ParseError("Element not closed: {}".format(repr(stack[-1][1] if stack else text[i:i + 50])))
+        j = m.start()
+        i = m.end()
+        doctype, end_tag, end_name, _question, start_name = m.groups()
+
+        if start_name:
+            add_start(j)
+            add_content_end(-1)
+            add_end(i)
+            add_size(0)
+            k = i - 2
+            while text[k] in _blank:
+                k -= 1
+            if text[k] != "/":
+                push((len(starts) - 1, start_name))
+            elif not stack:
+                return i
+
+        elif end_tag:
+            if not stack:
+                raise ParseError("Unexpected end tag: {}".format(repr(text[j:i])))
+            index, tag = pop()
+            if end_name != tag:
+                raise ParseError("Element {} closed by: {}".format(repr(tag), repr(text[j:i])))
+            content_ends[index] = j
+            ends[index] = i
+            sizes[index] = len(starts) - index - 1
+            if not stack:
+                return i
+
+        elif doctype:
+            is_success, result = _parse_doctype(text, j)
+            if not is_success:
+                raise ParseError("Unknown markup at: {}".format(repr(text[j:j + 50])))
+            i = result[1]
+
+        # 注释和问号元素不影响层数，跳过即可
+
+
+def _parse_lazy_element(text, i, space, ignore_comment, names=None):
+    is_success, result = _parse_start_tag(text, i, names)
+    if not is_success:
+        return False, None
+
+    e, begin, closed = result
+    if closed:
+        return True, (e, begin)
+
+    layout = _Layout(text, space, ignore_comment, names)
+    i = _scan_layout(text, i, layout)
+    if layout.content_ends[0] > begin:
+        e._kids = _Pending(layout, 0, begin, None)
+    return True, (e, i)
+
+
+def _parse_pending(element, pending):
+    # 解析一层子节点，子元素的内容仍然留到以后
+    layout = pending.layout
+    text = layout.text
+    starts = layout.starts
+    sizes = layout.sizes
+    ignore_comment = layout.ignore_comment
+    mode, xml_space = layout.space.mode(element._tag, element._attrs, pending.xml_space)
+
+    index = pending.index
+    i = pending.begin
+    kid_index = index + 1
+    last = index + sizes[index]
+
+    kids = []
+    while True:
+        stop = starts[kid_index] if kid_index <= last else layout.content_ends[index]
+
+        # 子元素之间的文本、注释等
+        while i < stop:
+            if text[i] != "<":
+                j = text.find("<", i, stop)
+                if j == -1:
+                    j = stop
+                s = _text_node(text, i, j, mode)
+                if s is not None:
+                    kids.append(s)
+                i = j
+                continue
+
+            is_success, result = _parse_markup(text, i)
+            if not is_success:
+                raise ParseError("Could not parse at: {}".format(repr(text[i:i + 50])))
+            term, i = result
+            if not (ignore_comment and type(term) is Comment):
+                kids.append(term)
+
+        if kid_index > last:
+            break
+
+        is_success, result = _parse_start_tag(text, stop, layout.names)
+        e, begin, closed = result
+        if closed:
+            i = begin
+        else:
+            if layout.content_ends[kid_index] > begin:
+                e._kids = _Pending(layout, kid_index, begin, xml_space)
+            i = layout.ends[kid_index]
+        kids.append(e)
+        kid_index += sizes[kid_index] + 1
+
+    return kids or None
 
 
 def _parse_comment(text, i):
@@ -577,12 +2017,14 @@ def _read_attr(text, i):
     qmark = text[i]
     i += 1
     string_value, i = _read_till(text, i, qmark)
-    return key, _unescape(string_value, _xml_attr_escape_table), i
+    return key, _unescape(string_value), i
 
 
 class Xml(object):
+    _index = None
+
     def __init__(self, root=None, prolog=None, doctype=None):
-        self._kids = []
+        self._kids = _new_kids(self)
 
         if prolog:
             self._kids.append(prolog)
@@ -593,24 +2035,61 @@ class Xml(object):
 
     @property
     def kids(self):
-        return self._kids
+        kids = self._kids
+        if type(kids) is not _Kids:
+            # pickle 还原出来的是普通列表
+            kids = self._kids = _new_kids(self, kids)
+        return kids
+
+    def _changed(self):
+        if self._index is not None:
+            self._index.changed(self)
+
+    def build_index(self, attrs=("id", "xml:id")):
+        return _build_index(self, attrs)
+
+    def track_parents(self):
+        return _track_parents(self)
+
+    def build_str_cache(self):
+        return _build_str_cache(self)
+
+    def find_all(self, tag, namespace=None):
+        if namespace is not None:
+            if self._index is not None:
+                return self._index.find_all_ns(self, tag, namespace, _default_nsmap)
+            return _find_all_ns(self.kids, tag, namespace, _default_nsmap)
+        if self._index is not None:
+            return self._index.find_all(tag)
+        return [e for e in _iter_elements(self.kids) if e.tag == tag]
+
+    def find_id(self, value, attrs=("id", "xml:id")):
+        if self._index is not None and self._index.attr_names == tuple(attrs):
+            return self._index.find_value(value)
+        return _find_value(self.kids, attrs, value)
+
+    def iter_find(self, path):
+        return _compile_query(path).select([self])
+
+    def find(self, path):
+        return next(self.iter_find(path), None)
 
     @property
     def root(self):
         for x in self.kids:
-            if type(x) is type(Element("x")):
+            if type(x) is Element:
                 return x
 
     @property
     def prolog(self):
         for x in self.kids:
-            if type(x) is type(Prolog()):
+            if type(x) is Prolog:
                 return x
 
     @property
     def doctype(self):
         for x in self.kids:
-            if type(x) is type(DocType()):
+            if type(x) is DocType:
                 return x
 
     def to_str(self,
@@ -619,80 +2098,1543 @@ class Xml(object):
                step=4,
                char=" ",
                dont_do_tags=None,
-               self_closing=None):
-        s = ''
-
+               self_closing=None,
+               stats=None):
+        if stats is not None:
+            return stats._to_str(self, self.iter_str(do_pretty, begin_indent, step, char, dont_do_tags, self_closing))
+        return "".join(self.iter_str(do_pretty, begin_indent, step, char, dont_do_tags, self_closing))
+
+    def iter_str(self,
+                 do_pretty=False,
+                 begin_indent=0,
+                 step=4,
+                 char=" ",
+                 dont_do_tags=None,
+                 self_closing=None):
         for x in self.kids:
-            s += x.to_str(do_pretty=do_pretty,
-                          begin_indent=begin_indent,
-                          step=step,
-                          char=char,
-                          dont_do_tags=dont_do_tags,
-                          self_closing=self_closing)
-            s += "\n"
+            yield from x.iter_str(do_pretty=do_pretty,
+                                  begin_indent=begin_indent,
+                                  step=step,
+                                  char=char,
+                                  dont_do_tags=dont_do_tags,
+                                  self_closing=self_closing)
+            yield "\n"
 
-        return s
+    def write(self, fp, *args, encoding=None, **kwargs):
+        if encoding is None:
+            encoding = self.prolog.encoding if self.prolog else "utf-8"
+        _write(fp, self.iter_str(*args, **kwargs), encoding)
 
 
-def _read_subs(text: str, i: int, *args, ignore_comment, **kwargs) -> tuple:
-    kids = []
-    # while True:
-    while i < len(text):
-        for fun in (_parse_prolog, _parse_doctype, _parse_comment, _parse_element, _parse_string):
-            if fun is _parse_element:
-                is_success, result = fun(text, i, *args, ignore_comment=ignore_comment, **kwargs)
-            else:
-                is_success, result = fun(text, i)
+class QueryError(Exception):
+    pass
 
-            if is_success:
-                term, i = result
-                if ignore_comment and (type(term) is type(Comment(""))):
-                    pass
-                elif term == "":
-                    pass
+
+_query_token_re = _re.compile(r"""
+    \s*(?:
+      (?P<sep>//|/)
+    | (?P<open>\[)
+    | (?P<close>\])
+    | (?P<op>!=|=|,|\(|\))
+    | (?P<string>"[^"]*"|'[^']*')
+    | (?P<number>[0-9]+(?![^\s\[\]/=!,()]))
+    | (?P<name>@?[^\s\[\]/=!,()"']+)
+    )""", _re.VERBOSE)
+
+
+def _tokenize_query(path):
+    tokens = []
+    i = 0
+    path = path.strip()
+    while i < len(path):
+        m = _query_token_re.match(path, i)
+        if m is None or m.end() == i:
+            raise QueryError("Bad query {}: at {}".format(repr(path), repr(path[i:])))
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == "string":
+            value = value[1:-1]
+        tokens.append((kind, value))
+        i = m.end()
+    return tokens
+
+
+def _element_text(e):
+    return "".join(x for x in _load(e) or () if isinstance(x, str))
+
+
+def _compile_predicate(tokens, path):
+    # [@a] [@a="v"] [@a!="v"] [2] [last()] [text()="v"] [contains(text(), "v")] [contains(@a, "v")]
+    def expect(kind, value=None):
+        if not tokens or tokens[0][0] != kind or (value is not None and tokens[0][1] != value):
+            raise QueryError("Bad predicate in query {}".format(repr(path)))
+        return tokens.pop(0)[1]
+
+    def operand():
+        name = expect("name")
+        if name == "text" and tokens[:1] == [("op", "(")]:
+            expect("op", "(")
+            expect("op", ")")
+            return _element_text
+        if name.startswith("@") and len(name) > 1:
+            attr = name[1:]
+            return lambda e: e._attrs.get(attr) if e._attrs else None
+        raise QueryError("Bad operand {} in query {}".format(repr(name), repr(path)))
+
+    kind, value = tokens[0]
+    if kind == "number":
+        tokens.pop(0)
+        index = int(value) - 1
+        if index < 0:
+            raise QueryError("Position starts at 1 in query {}".format(repr(path)))
+        predicate = ("position", index)
+
+    elif kind == "name" and value == "last":
+        tokens.pop(0)
+        expect("op", "(")
+        expect("op", ")")
+        predicate = ("position", -1)
+
+    elif kind == "name" and value == "contains":
+        tokens.pop(0)
+        expect("op", "(")
+        get = operand()
+        expect("op", ",")
+        needle = expect("string")
+        expect("op", ")")
+        predicate = ("filter", lambda e: needle in (get(e) or ""))
+
+    else:
+        get = operand()
+        if tokens and tokens[0][0] == "op" and tokens[0][1] in ("=", "!="):
+            op = tokens.pop(0)[1]
+            expected = expect("string")
+            if op == "=":
+                predicate = ("filter", lambda e: get(e) == expected)
+            else:
+                predicate = ("filter", lambda e: get(e) not in (None, expected))
+        else:
+            predicate = ("filter", lambda e: get(e) is not None)
+
+    expect("close")
+    return predicate
+
+
+class _Query(object):
+    def __init__(self, path, steps):
+        self.path = path
+        self.steps = steps
+
+    def select(self, nodes):
+        for axis, tag, predicates in self.steps:
+            nodes = _apply_step(nodes, axis, tag, predicates)
+        return nodes
+
+
+def _iter_kid_lists(node):
+    yield _load(node) or ()
+    for e in _iter_elements(node._kids or ()):
+        yield e._kids or ()
+
+
+def _apply_step(nodes, axis, tag, predicates):
+    seen = set()
+    positional = any(kind == "position" for kind, x in predicates)
+    for node in nodes:
+        if axis == "self":
+            groups = [[node]] if tag in ("*", ".") or getattr(node, "tag", None) == tag else []
+        elif axis == "child":
+            groups = [_load(node) or ()]
+        elif positional:
+            # //p[1] 指的是每个父元素下的第一个 p，所以按父元素分组
+            groups = _iter_kid_lists(node)
+        elif tag not in ("*", ".") and node._index is not None and node._index.owner is node:
+            groups = [[x for x in node._index.find_all(tag) if x is not node]]
+        else:
+            groups = [_iter_elements(_load(node) or ())]
+
+        for group in groups:
+            candidates = (x for x in group if isinstance(x, Element) and (tag in ("*", ".") or x.tag == tag))
+            for kind, value in predicates:
+                if kind == "position":
+                    candidates = list(candidates)
+                    candidates = candidates[value:value + 1] if value != -1 else candidates[-1:]
                 else:
-                    kids.append(term)
-                break
+                    candidates = filter(value, candidates)
+            for x in candidates:
+                if id(x) not in seen:
+                    seen.add(id(x))
+                    yield x
+
+
+@_functools.lru_cache(maxsize=256)
+def _compile_query(path):
+    tokens = _tokenize_query(path)
+    if not tokens:
+        raise QueryError("Empty query")
+
+    steps = []
+    axis = "child"
+    if tokens[0] == ("sep", "//"):
+        axis = "descendant"
+        tokens.pop(0)
+    elif tokens[0] == ("sep", "/"):
+        raise QueryError("Absolute query is not supported: {}".format(repr(path)))
+
+    while True:
+        kind, tag = tokens.pop(0) if tokens else (None, None)
+        if kind != "name" or tag.startswith("@"):
+            raise QueryError("Tag name expected in query {}".format(repr(path)))
+        if tag == ".":
+            axis = "self" if axis == "child" else axis
+        predicates = []
+        while tokens and tokens[0][0] == "open":
+            tokens.pop(0)
+            if not tokens:
+                raise QueryError("Bad predicate in query {}".format(repr(path)))
+            predicates.append(_compile_predicate(tokens, path))
+        steps.append((axis, tag, tuple(predicates)))
+
+        if not tokens:
+            break
+        kind, sep = tokens.pop(0)
+        if kind != "sep":
+            raise QueryError("Unexpected {} in query {}".format(repr(sep), repr(path)))
+        axis = "descendant" if sep == "//" else "child"
 
-        if is_success:
-            continue
+    return _Query(path, steps)
+
+
+def _read_subs(text: str, i: int, do_strip=None, dont_do_tags=None, ignore_comment=False, lazy=False,
+               names=None, whitespace=None) -> tuple:
+    space = _Whitespace(whitespace, do_strip, dont_do_tags)
+    kids = []
+    while i < len(text):
+        if text[i] != "<":
+            # 顶层的空白不需要变成字符串
+            i = _ignore_blank(text, i)
+            if i == len(text):
+                break
+        if text[i] != "<":
+            is_success, result = _parse_string(text, i)
         else:
+            is_success, result = _parse_markup(text, i)
+            if not is_success:
+                if lazy:
+                    is_success, result = _parse_lazy_element(text, i, space, ignore_comment, names)
+                else:
+                    is_success, result = _parse_element(text, i, ignore_comment=ignore_comment, names=names,
+                                                        whitespace=space)
+
+        if not is_success:
             break
-    # print(kids)
+
+        term, i = result
+        if ignore_comment and type(term) is Comment:
+            continue
+        kids.append(term)
+
     return kids, i
 
 
-def parse(text, do_strip: bool = None, dont_do_tags: list[str] or tuple[str] = None, ignore_comment: bool = False)\
-        -> Xml:
-    kids, i = _read_subs(text, 0, do_strip=do_strip, dont_do_tags=dont_do_tags, ignore_comment=ignore_comment)
+class Stats(object):
+    """
+    传给 parse、parse_e、to_str 的 stats 参数，收集节点个数、最大层数、处理的字符数、各阶段的耗时和最长的几段文本。
+    同一个 Stats 可以传给多次调用，结果累加。
+    hook(element, seconds) 在解析完每个元素时调用，seconds 是从开始标签到结束标签的时间。
+    """
+    phases = ("tags", "attrs", "text", "unescape", "comments")
+
+    def __init__(self, hook=None, top=5):
+        self.hook = hook
+        self.top = top
+        self.counts = {"element": 0, "text": 0, "comment": 0, "pi": 0, "doctype": 0}
+        self.max_depth = 0
+        self.chars = 0
+        self.times = dict.fromkeys(self.phases + ("parse", "to_str"), 0.0)
+        self.largest_texts = []
+
+    def __repr__(self):
+        return "<Stats counts={} max_depth={} chars={} times={}>".format(self.counts, self.max_depth, self.chars,
+                                                                         self.times)
+
+    def _parse(self, func, text, *args, **kwargs):
+        # 用 _instrument 复制出来的 func 解析
+        func = _instrument(self)[func.__name__]
+        begin = _time.perf_counter()
+        result = func(text, *args, **kwargs)
+        self.times["parse"] += _time.perf_counter() - begin
+        self.chars += len(text)
+        self._count(result.kids if isinstance(result, Xml) else [result])
+        return result
+
+    def _to_str(self, node, iter_str):
+        begin = _time.perf_counter()
+        s = "".join(iter_str)
+        self.times["to_str"] += _time.perf_counter() - begin
+        self.chars += len(s)
+        self._count(node.kids if isinstance(node, Xml) else [node])
+        return s
+
+    def _count(self, nodes):
+        counts = self.counts
+        texts = []
+        stack = [(nodes, 0)]
+        while stack:
+            kids, depth = stack.pop()
+            for x in kids:
+                if type(x) is str:
+                    counts["text"] += 1
+                    texts.append(x)
+                elif isinstance(x, QMElement):
+                    counts["pi"] += 1
+                elif isinstance(x, Element):
+                    counts["element"] += 1
+                    if depth + 1 > self.max_depth:
+                        self.max_depth = depth + 1
+                    if _load(x):
+                        stack.append((x._kids, depth + 1))
+                elif isinstance(x, Comment):
+                    counts["comment"] += 1
+                elif isinstance(x, DocType):
+                    counts["doctype"] += 1
+        self.largest_texts = _heapq.nlargest(self.top, self.largest_texts + texts, key=len)
+
+
+_timed_functions = {
+    "_parse_start_tag": "tags",
+    "_parse_end_tag": "tags",
+    "_read_attr": "attrs",
+    "_text_node": "text",
+    "_unescape": "unescape",
+    "_parse_comment": "comments",
+}
+
+
+def _timed(times, phase, func, timing):
+    # 只记 func 自己的时间，里面调用的其他计时函数的时间记到它们各自的阶段
+    perf_counter = _time.perf_counter
+
+    def wrapper(*args):
+        timing.append(0.0)
+        begin = perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = perf_counter() - begin
+            times[phase] += elapsed - timing.pop()
+            if timing:
+                timing[-1] += elapsed
+    return wrapper
+
+
+def _instrument(stats):
+    # 复制本模块的函数，换上新的 globals，其中几个函数换成计时的版本。
+    # 只有传了 stats 的调用才走这套复制品，平常的解析没有任何额外开销
+    namespace = dict(globals())
+    for name, value in globals().items():
+        if type(value) is _types.FunctionType and value.__module__ == __name__:
+            clone = _types.FunctionType(value.__code__, namespace, value.__name__, value.__defaults__,
+                                        value.__closure__)
+            clone.__kwdefaults__ = value.__kwdefaults__
+            namespace[name] = clone
+
+    timing = []
+    for name, phase in _timed_functions.items():
+        namespace[name] = _timed(stats.times, phase, namespace[name], timing)
+
+    if stats.hook is not None:
+        hook = stats.hook
+        perf_counter = _time.perf_counter
+        parse_start_tag = namespace["_parse_start_tag"]
+        parse_end_tag = namespace["_parse_end_tag"]
+        opened = []
+
+        def start_tag_hook(text, i, names=None):
+            begin = perf_counter()
+            is_success, result = parse_start_tag(text, i, names)
+            if is_success:
+                if result[2]:
+                    hook(result[0], perf_counter() - begin)
+                else:
+                    opened.append((result[0], begin))
+            return is_success, result
+
+        def end_tag_hook(text, i, tag):
+            is_success, result = parse_end_tag(text, i, tag)
+            if is_success:
+                e, begin = opened.pop()
+                hook(e, perf_counter() - begin)
+            return is_success, result
+
+        namespace["_parse_start_tag"] = start_tag_hook
+        namespace["_parse_end_tag"] = end_tag_hook
+    return namespace
+
+
+def parse(text, do_strip: bool = None, dont_do_tags: list[str] or tuple[str] = None, ignore_comment: bool = False,
+          index: bool = False, lazy: bool = False, stats: Stats = None, target=None, keep=None, skip=None,
+          names=None, parents: bool = False, whitespace=None) -> Xml:
+    # whitespace 是 "preserve"、"strip"、"collapse"，或者 {tag: 处理方式, None: 其他元素的处理方式}，见 _Whitespace。
+    # 空白在扫描时就按它处理，可以忽略的空白不会变成字符串。
+    # lazy=True 时只找出每个元素的起止位置，元素的 kids 在第一次被访问时才解析。
+    # parents=True 时解析完就调用 track_parents，元素的 parent、next 等属性可以直接用。
+    # 指定 target 时不建立树，而是调用 target 的方法（见 _parse_target），返回 target.close() 的结果。
+    # keep、skip 见 _parse_selective。
+    # 同名的 tag、属性名共用一个字符串；names 是 Names 时，多次解析共用它，否则每次解析用一个新表
+    if names is None:
+        names = {}
+    if keep is not None or skip is not None:
+        if lazy or target is not None:
+            raise ValueError("keep and skip are not supported with lazy or target")
+        if stats is not None and stats.hook is not None:
+            # 挑选时开始标签不经过 _parse_start_tag，hook 拿不到元素
+            raise ValueError("Stats.hook is not supported with keep or skip")
+        if stats is None:
+            xml = Xml()
+            space = _Whitespace(whitespace, do_strip, dont_do_tags)
+            xml.kids.extend(_parse_selective(text, _selector(keep), _selector(skip), space, ignore_comment, names))
+            if index:
+                xml.build_index()
+            if parents:
+                xml.track_parents()
+            return xml
+
+    if target is not None:
+        if lazy or index or parents or stats is not None:
+            raise ValueError("lazy, index, parents and stats are not supported with target")
+        _parse_target(text, target, _Whitespace(whitespace, do_strip, dont_do_tags), ignore_comment, names)
+        close = getattr(target, "close", None)
+        return close() if close is not None else None
+
+    if stats is not None:
+        if lazy:
+            raise ValueError("stats is not supported with lazy=True")
+        return stats._parse(parse, text, do_strip, dont_do_tags, ignore_comment, index, keep=keep, skip=skip,
+                            names=names, parents=parents, whitespace=whitespace)
+
+    kids, i = _read_subs(text, 0, do_strip=do_strip, dont_do_tags=dont_do_tags, ignore_comment=ignore_comment,
+                         lazy=lazy, names=names, whitespace=whitespace)
 
     xml = Xml()
     for kid in kids:
         if not isinstance(kid, str):
             xml.kids.append(kid)
 
+    if index:
+        xml.build_index()
+    if parents:
+        xml.track_parents()
     return xml
 
 
-def parse_e(text, *args, **kwargs):
+def parse_e(text, *args, stats=None, **kwargs):
+    if stats is not None:
+        return stats._parse(parse_e, text, *args, **kwargs)
+
+    kwargs.setdefault("names", {})
     i = _ignore_blank(text, 0)
-    is_success, (root, i) = _parse_element(text, i, *args, **kwargs)
+    is_success, result = _parse_element(text, i, *args, **kwargs)
+    if not is_success:
+        raise ParseError("Could not parse element at: {}".format(repr(text[i:i + 50])))
+    root, i = result
     i = _ignore_blank(text, i)
     if len(text) != i:
         raise ParseError("Some text could not parse: {}".format(repr(text[i:])))
     return root
 
 
-def _read_till(text, bi, stoptext):
-    _text = ""
-    while bi < len(text):
-        if text[bi:bi + len(stoptext)] == stoptext:
-            return _text, bi + len(stoptext)
+def _tail_separator(value):
+    if value is True:
+        return "\n"
+    return value or None
+
+
+def _is_selected(selector, e):
+    if type(selector) is frozenset:
+        return e._tag in selector
+    return selector(e._tag, e._attrs or {})
+
+
+def _itertext(element, skip, separator):
+    # 用迭代器的栈遍历，不递归，也不建立中间的列表。pending 表示刚过了一个元素的边界
+    if skip is not None and _is_selected(skip, element):
+        return
+    pending = False
+    stack = [iter(_load(element) or ())]
+    while stack:
+        for _kid in stack[-1]:
+            if type(_kid) is str:
+                if pending:
+                    yield separator
+                    pending = False
+                yield _kid
+            elif isinstance(_kid, Element) and not isinstance(_kid, QMElement):
+                if skip is not None and _is_selected(skip, _kid):
+                    pending = separator is not None
+                    continue
+                kids = _load(_kid)
+                if kids:
+                    stack.append(iter(kids))
+                    break
+                pending = separator is not None
+        else:
+            stack.pop()
+            pending = separator is not None
+
+
+def _selector(spec):
+    # keep、skip 可以是一个 tag、一组 tag，或者 f(tag, attrs) 函数。一组 tag 变成 frozenset，
+    # 这样只看 tag 就能判断，不需要读属性
+    if spec is None or callable(spec):
+        return spec
+    return frozenset([spec] if isinstance(spec, str) else spec)
+
+
+def _skip_element(text, i, tag):
+    # i 是 tag 的开始标签之后的位置，只数标签的层数，跳到对应的结束标签之后
+    depth = 1
+    search = _layout_re.search
+    while True:
+        m = search(text, i)
+        if m is None:
+            raise ParseError("Element not closed: {}".format(repr(tag)))
+        j = m.start()
+        i = m.end()
+        doctype, end_tag, end_name, _question, start_name = m.groups()
+        if start_name:
+            k = i - 2
+            while text[k] in _blank:
+                k -= 1
+            if text[k] != "/":
+                depth += 1
+        elif end_tag:
+            depth -= 1
+            if depth == 0:
+                if end_name != tag:
+                    raise ParseError("Element {} closed by: {}".format(repr(tag), repr(text[j:i])))
+                return i
+        elif doctype:
+            is_success, result = _parse_doctype(text, j)
+            if not is_success:
+                raise ParseError("Unknown markup at: {}".format(repr(text[j:j + 50])))
+            i = result[1]
+
+
+def _start_tag_end(text, i):
+    # 不读属性，返回 text[i] 处开始标签之后的位置和它是否自闭合
+    m = _tag_end_re.match(text, i + 1)
+    if m is None:
+        raise ParseError("Could not parse at: {}".format(repr(text[i:i + 50])))
+    j = m.end()
+    k = j - 2
+    while text[k] in _blank:
+        k -= 1
+    if text[k] == "/":
+        return j, True
+    return j, False
+
+
+def _parse_selective(text, keep, skip, space, ignore_comment, names=None):
+    # 返回顶层节点。skip 选中的元素整个跳过，只数标签不建立节点；
+    # 指定 keep 时，只有 keep 选中的元素（连同其子树）被建立，放在顶层，其他元素只是穿过去，
+    # 它们的文本、注释都不会变成对象。space 是 _Whitespace；只穿过去的元素不读属性，它们的 xml:space 不起作用
+    keep_names = keep if type(keep) is frozenset else None
+    skip_names = skip if type(skip) is frozenset else None
+    # skip 是函数时要读属性才知道是否跳过，穿过去的元素也不能只看 tag
+    pass_by_name = keep_names is not None and (skip is None or skip_names is not None)
+    roots = []
+    stack = []
+    tag = None
+    element = None
+    kids = roots
+    mode, xml_space = _STRIP, None
+    length = len(text)
+    i = 0
+    while i < length:
+        if text[i] != "<":
+            j = text.find("<", i)
+            if j == -1:
+                j = length
+            if element is not None:
+                s = _text_node(text, i, j, mode)
+                if s is not None:
+                    kids.append(s)
+            i = j
+            continue
+
+        if text[i + 1:i + 2] != "/":
+            if text.startswith("<!--", i):
+                comment_text, i = _read_till(text, i + 4, "-->")
+                if kids is not None and not ignore_comment:
+                    kids.append(Comment(_unescape_comment(comment_text)))
+                continue
+
+            is_success, result = _parse_markup(text, i)
+            if is_success:
+                term, i = result
+                if kids is not None:
+                    kids.append(term)
+                continue
+
+            if skip_names is not None or (pass_by_name and element is None):
+                # 只看 tag 就能决定的，不读属性
+                name = _read_tag(text, _ignore_blank(text, i + 1))[0]
+                if name in (skip_names or ()):
+                    j, closed = _start_tag_end(text, i)
+                    i = j if closed else _skip_element(text, j, name)
+                    continue
+                if element is None and pass_by_name and name not in keep_names:
+                    j, closed = _start_tag_end(text, i)
+                    if not closed:
+                        stack.append((tag, element, kids, mode, xml_space))
+                        tag, kids = name, None
+                    i = j
+                    continue
+
+            result = _read_start_tag(text, i, names)
+            if result is None:
+                raise ParseError("Could not parse at: {}".format(repr(text[i:i + 50])))
+            name, attrs, j, closed = result
+            if skip is not None and skip_names is None and skip(name, attrs or {}):
+                i = j if closed else _skip_element(text, j, name)
+                continue
+
+            if (element is not None or keep is None
+                    or (name in keep_names if keep_names is not None else keep(name, attrs or {}))):
+                e = _make_element(name, attrs, closed)
+                (kids if element is not None else roots).append(e)
+            else:
+                e = None
+            if not closed:
+                stack.append((tag, element, kids, mode, xml_space))
+                tag = name
+                element = e
+                kids = _kids_of(e) if e is not None else None
+                mode, xml_space = space.mode(name, attrs, xml_space)
+            i = j
+            continue
+
+        if tag is None:
+            raise ParseError("Could not parse at: {}".format(repr(text[i:i + 50])))
+        is_success, j = _parse_end_tag(text, i, tag)
+        if not is_success:
+            raise ParseError("Element {} closed by: {}".format(repr(tag), repr(text[i:i + 50])))
+        i = j
+        if element is not None and not kids:
+            element._kids = None
+        tag, element, kids, mode, xml_space = stack.pop()
+
+    if tag is not None:
+        raise ParseError("Element not closed: {}".format(repr(tag)))
+    return roots
+
+
+def _ignore_event(*args):
+    pass
+
+
+def _parse_target(text, target, space, ignore_comment, names=None):
+    # 逐个标签调用 target.start(tag, attrs)、end(tag)、data(text)、comment(text)、pi(tag, attrs)、doctype(text)，
+    # target 没有的方法跳过。<a/> 这样的空元素标签，target 有 empty(tag, attrs) 时调用它，否则调用 start 和 end。
+    # 不建立 Element，空白按 space（_Whitespace）处理，与 parse 相同，顶层的文本同样丢掉
+    start = getattr(target, "start", _ignore_event)
+    end = getattr(target, "end", _ignore_event)
+    data = getattr(target, "data", _ignore_event)
+    comment = getattr(target, "comment", _ignore_event)
+    pi = getattr(target, "pi", _ignore_event)
+    doctype = getattr(target, "doctype", _ignore_event)
+    empty = getattr(target, "empty", None)
+
+    length = len(text)
+    stack = []
+    i = 0
+    while i < length:
+        if text[i] != "<":
+            j = text.find("<", i)
+            if j == -1:
+                j = length
+            if stack:
+                s = _text_node(text, i, j, stack[-1][1])
+                if s is not None:
+                    data(s)
+            i = j
+            continue
+
+        if text[i + 1:i + 2] != "/":
+            if text.startswith("<!--", i):
+                comment_text, i = _read_till(text, i + 4, "-->")
+                if not ignore_comment:
+                    comment(_unescape_comment(comment_text))
+                continue
+
+            is_success, result = _parse_markup(text, i)
+            if is_success:
+                term, i = result
+                if type(term) is DocType:
+                    doctype(term.text)
+                else:
+                    pi(term.tag, dict(term.attrs))
+                continue
+
+            result = _read_start_tag(text, i, names)
+            if result is not None:
+                tag, attrs, i, closed = result
+                if not closed:
+                    start(tag, attrs or {})
+                    stack.append((tag,) + space.mode(tag, attrs, stack[-1][2] if stack else None))
+                elif empty is not None:
+                    empty(tag, attrs or {})
+                else:
+                    start(tag, attrs or {})
+                    end(tag)
+                continue
+
+        if not stack:
+            raise ParseError("Could not parse at: {}".format(repr(text[i:i + 50])))
+        is_success, j = _parse_end_tag(text, i, stack[-1][0])
+        if not is_success:
+            raise ParseError("Element {} closed by: {}".format(repr(stack[-1][0]), repr(text[i:i + 50])))
+        i = j
+        end(stack.pop()[0])
+
+    if stack:
+        raise ParseError("Element not closed: {}".format(repr(stack[-1][0])))
+
+
+class TreeBuilder(object):
+    """ parse(text, target=TreeBuilder()) 建立的树与 parse(text) 相同 """
+    def __init__(self):
+        self._xml = Xml()
+        self._stack = []
+
+    def _add(self, node):
+        if self._stack:
+            _kids_of(self._stack[-1]).append(node)
+        else:
+            self._xml.kids.append(node)
+
+    def start(self, tag, attrs):
+        e = _make_element(tag, dict(attrs) if attrs else None, False)
+        self._add(e)
+        self._stack.append(e)
+
+    def end(self, tag):
+        self._stack.pop()
+
+    def empty(self, tag, attrs):
+        self._add(_make_element(tag, dict(attrs) if attrs else None, True))
+
+    def data(self, text):
+        if self._stack:
+            _kids_of(self._stack[-1]).append(text)
+
+    def comment(self, text):
+        self._add(Comment(text))
+
+    def pi(self, tag, attrs):
+        if tag == "xml":
+            e = Prolog()
+            e.attrs.clear()
+            e.attrs.update(attrs)
         else:
-            _text += text[bi]
-            bi += 1
-    return _text, bi
+            e = QMElement(tag, attrs)
+        self._add(e)
+
+    def doctype(self, text):
+        self._add(DocType(text))
+
+    def close(self):
+        if self._stack:
+            raise ParseError("Element not closed: {}".format(repr(self._stack[-1].tag)))
+        return self._xml
+
+
+def _read_till(text, bi, stoptext):
+    j = text.find(stoptext, bi)
+    if j == -1:
+        return text[bi:], max(bi, len(text))
+    return text[bi:j], j + len(stoptext)
 
 
 class ParseError(Exception):
     pass
+
+
+_tag_end_re = _re.compile(r"""[^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*>""")
+
+
+def _markup_end(text, i):
+    # 返回 text[i] 处标签的结束位置，标签不完整时返回 -1
+    if text.startswith("<!", i):
+        if len(text) - i < 4 and "<!--".startswith(text[i:]):
+            return -1
+        if text.startswith("<!--", i):
+            j = text.find("-->", i + 4)
+            return -1 if j == -1 else j + 3
+
+        if len(text) - i < 10 and "<!DOCTYPE ".startswith(text[i:]):
+            return -1
+        if text.startswith("<!DOCTYPE ", i):
+            lessthan = 0
+            greaterthan = 0
+            for m in _angle_re.finditer(text, i + 10):
+                if m.group() == ">":
+                    greaterthan += 1
+                else:
+                    lessthan += 1
+                if greaterthan - lessthan == 1:
+                    return m.end()
+            return -1
+
+        raise ParseError("Unknown markup: {}".format(repr(text[i:i + 50])))
+
+    m = _tag_end_re.match(text, i + 1)
+    return -1 if m is None else m.end()
+
+
+class _PullParser(object):
+    # 一块一块地喂入文本，凑齐一个完整的标签或文本节点就解析它，
+    # 不需要整篇文档都在内存里
+    def __init__(self, events=("end",), dont_do_tags=None, ignore_comment=False, keep_roots=False, names=None,
+                 do_strip=None, whitespace=None):
+        # keep_roots 为真时，顶层节点收集在 self.roots 里
+        self.roots = [] if keep_roots else None
+        self._names = {} if names is None else names
+        self._buf = ""
+        self._pos = 0
+        self._hint = 0
+        self._stack = []
+        self._events = []
+        self._wanted = frozenset(events)
+        self._space = _Whitespace(whitespace, do_strip, dont_do_tags)
+        self._ignore_comment = ignore_comment
+
+    def feed(self, data):
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+        self._parse(False)
+
+    def close(self):
+        self._parse(True)
+        if self._stack:
+            raise ParseError("Element not closed: {}".format(repr(self._stack[-1][0].tag)))
+        self._buf = ""
+        self._pos = 0
+
+    def read_events(self):
+        events = self._events
+        self._events = []
+        return events
+
+    def _add_event(self, event, obj):
+        if event in self._wanted:
+            self._events.append((event, obj))
+
+    def _add_kid(self, term):
+        if self._stack:
+            _kids_of(self._stack[-1][0]).append(term)
+        elif self.roots is not None:
+            self.roots.append(term)
+
+    def _parse(self, final):
+        buf = self._buf
+        i = self._pos
+        length = len(buf)
+
+        while i < length:
+            if buf[i] != "<":
+                j = buf.find("<", i + self._hint)
+                if j == -1:
+                    if not final:
+                        self._hint = length - i
+                        break
+                    j = length
+                self._hint = 0
+                self._handle_text(buf, i, j)
+                i = j
+                continue
+
+            j = _markup_end(buf, i)
+            if j == -1:
+                if final:
+                    raise ParseError("Incomplete markup: {}".format(repr(buf[i:i + 50])))
+                break
+            self._handle_markup(buf[i:j])
+            i = j
+
+        self._pos = i
+
+    def _handle_text(self, buf, i, j):
+        if not self._stack:
+            return
+        element, mode, xml_space = self._stack[-1]
+        s = _text_node(buf, i, j, mode)
+        if s is not None:
+            _kids_of(element).append(s)
+            self._add_event("text", s)
+
+    def _handle_markup(self, token):
+        if token[1:2] != "/":
+            is_success, result = _parse_markup(token, 0)
+            if is_success:
+                term, i = result
+                if isinstance(term, Comment):
+                    if not self._ignore_comment:
+                        self._add_kid(term)
+                        self._add_event("comment", term)
+                elif isinstance(term, DocType):
+                    self._add_kid(term)
+                    self._add_event("doctype", term)
+                else:
+                    self._add_kid(term)
+                    self._add_event("pi", term)
+                return
+
+            is_success, result = _parse_start_tag(token, 0, self._names)
+            if is_success:
+                e, i, closed = result
+                self._add_kid(e)
+                self._add_event("start", e)
+                if closed:
+                    self._add_event("end", e)
+                else:
+                    xml_space = self._stack[-1][2] if self._stack else None
+                    self._stack.append((e,) + self._space.mode(e.tag, e._attrs, xml_space))
+                return
+
+        if self._stack:
+            element = self._stack[-1][0]
+            is_success, i = _parse_end_tag(token, 0, element.tag)
+            if is_success and i == len(token):
+                element.self_closing = False
+                self._stack.pop()
+                self._add_event("end", element)
+                return
+
+        raise ParseError("Could not parse: {}".format(repr(token[:50])))
+
+
+_boms = (
+    (_codecs.BOM_UTF32_LE, "utf-32"),
+    (_codecs.BOM_UTF32_BE, "utf-32"),
+    (_codecs.BOM_UTF8, "utf-8-sig"),
+    (_codecs.BOM_UTF16_LE, "utf-16"),
+    (_codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+_signatures = tuple(bom for bom, encoding in _boms) + (b"<\0?\0", b"\0<\0?", b"<?xml")
+
+_max_declaration_size = 1024
+
+
+def _detect_encoding(head, final=False):
+    # 根据 BOM 或 <?xml ... encoding="..."?> 判断编码。head 是文档开头的字节，
+    # 声明还没有读全时返回 None，需要更多字节
+    head = bytes(head[:_max_declaration_size])
+    if not final and len(head) < 5 and any(x.startswith(head) for x in _signatures):
+        return None
+    for bom, encoding in _boms:
+        if head.startswith(bom):
+            return encoding
+    if head.startswith(b"<\0?\0"):
+        return "utf-16-le"
+    if head.startswith(b"\0<\0?"):
+        return "utf-16-be"
+
+    if not head.startswith(b"<?xml"):
+        return "utf-8"
+
+    end = head.find(b"?>")
+    if end == -1:
+        if not final and len(head) < _max_declaration_size:
+            return None
+        return "utf-8"
+
+    is_success, result = _parse_prolog(head[:end + 2].decode("latin-1"), 0)
+    if not is_success or not isinstance(result[0], Prolog):
+        return "utf-8"
+    encoding = result[0].encoding
+    try:
+        _codecs.lookup(encoding)
+    except LookupError:
+        raise ParseError("Unknown encoding: {}".format(repr(encoding)))
+    return encoding
+
+
+class FeedParser(object):
+    """
+    增量解析器：feed(data) 喂入任意大小的一块 str 或 bytes，标签、属性、注释、实体被切断也没关系。
+    read_events() 取出目前为止的 (事件, 节点)，事件与 iterparse 相同；close() 结束解析，返回 Xml。
+    bytes 的编码没有指定时，按 BOM 或 XML 声明判断。空白的处理与 parse 相同。
+    """
+    def __init__(self, events=("end",), dont_do_tags=None, ignore_comment=False, encoding=None, names=None,
+                 do_strip=None, whitespace=None):
+        self._parser = _PullParser(events, dont_do_tags=dont_do_tags, ignore_comment=ignore_comment,
+                                   keep_roots=True, names=names, do_strip=do_strip, whitespace=whitespace)
+        self._encoding = encoding
+        self._decoder = None
+        self._head = b""
+
+    def feed(self, data):
+        if not isinstance(data, str):
+            if self._decoder is None:
+                self._head += data
+                encoding = self._encoding or _detect_encoding(self._head)
+                if encoding is None:
+                    return
+                self._decoder = _codecs.getincrementaldecoder(encoding)()
+                data = self._head
+                self._head = b""
+            data = self._decoder.decode(data)
+        self._parser.feed(data)
+
+    def read_events(self):
+        return self._parser.read_events()
+
+    def close(self):
+        if self._head:
+            encoding = self._encoding or _detect_encoding(self._head, final=True)
+            self._decoder = _codecs.getincrementaldecoder(encoding)()
+            self._parser.feed(self._decoder.decode(self._head))
+            self._head = b""
+        if self._decoder is not None:
+            self._parser.feed(self._decoder.decode(b"", final=True))
+        self._parser.close()
+        xml = Xml()
+        xml.kids.extend(self._parser.roots)
+        return xml
+
+
+def iterparse(fp, events=("end",), dont_do_tags=None, ignore_comment=False, encoding=None, chunk_size=65536,
+              names=None, whitespace=None):
+    """
+    逐块读取文件对象 fp，产生 (事件, 节点)。事件有 "start"、"end"、"text"、"comment"、"pi" 和 "doctype"。
+    元素仍挂在父元素的 kids 里，只调用 element.clear() 时空元素本身会一直留着。要让内存不随文件增长，
+    "end" 之后清空元素，再把它从父元素上摘掉，例如在 "start" 时记下 root，每个记录的 "end" 之后：
+        element.clear()
+        root.kids.clear()
+    二进制流的编码没有指定时，按 BOM 或 XML 声明判断。
+    """
+    parser = FeedParser(events, dont_do_tags=dont_do_tags, ignore_comment=ignore_comment, encoding=encoding,
+                        names=names, whitespace=whitespace)
+    while True:
+        data = fp.read(chunk_size)
+        if not data:
+            break
+        parser.feed(data)
+        yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+
+def iterparse_text(fp, skip_tags=None, with_tail_separators=False, dont_do_tags=None, encoding=None,
+                   chunk_size=65536):
+    """
+    与 Element.itertext 产生同样的文本，但边读 fp 边产生：用完的元素随即丢掉，不需要整棵树都在内存里。
+    skip_tags 为 f(tag, attrs) 时，attrs 已经读全
+    """
+    skip = _selector(skip_tags)
+    separator = _tail_separator(with_tail_separators)
+    stack = []
+    skipping = 0
+    pending = False
+    for event, obj in iterparse(fp, ("start", "end", "text"), dont_do_tags=dont_do_tags, ignore_comment=True,
+                                encoding=encoding, chunk_size=chunk_size):
+        if event == "text":
+            if not skipping and stack:
+                if pending:
+                    yield separator
+                    pending = False
+                yield obj
+        elif event == "start":
+            stack.append(obj)
+            if skipping or (skip is not None and _is_selected(skip, obj)):
+                skipping += 1
+        else:
+            stack.pop()
+            if skipping:
+                skipping -= 1
+            # 父元素里在它之前的都已经用完了；之后的节点已经在事件里，也不需要留在树上
+            if stack:
+                del stack[-1].kids[:]
+            if stack and not skipping:
+                pending = separator is not None
+
+
+async def aiterparse(reader, events=("end",), dont_do_tags=None, ignore_comment=False, encoding=None,
+                     chunk_size=65536, names=None, whitespace=None):
+    """
+    iterparse 的异步版本：reader 是 asyncio.StreamReader，或者任何有 async read(n) 方法的对象。
+    每读到一块就解析，网络读取和解析可以交错进行。
+    """
+    parser = FeedParser(events, dont_do_tags=dont_do_tags, ignore_comment=ignore_comment, encoding=encoding,
+                        names=names, whitespace=whitespace)
+    while True:
+        data = await reader.read(chunk_size)
+        if not data:
+            break
+        parser.feed(data)
+        for event in parser.read_events():
+            yield event
+    parser.close()
+    for event in parser.read_events():
+        yield event
+
+
+async def aiter_elements(reader, depth=1, dont_do_tags=None, ignore_comment=False, encoding=None,
+                         chunk_size=65536):
+    """
+    从 reader 读取，产生深度为 depth 的完整元素：depth 为 0 时是根元素，为 1 时是根元素的子元素，依此类推。
+    产生的元素已经从父元素的 kids 中移除，长时间的流（比如 XMPP）不会越积越多。
+    """
+    stack = []
+    async for event, e in aiterparse(reader, ("start", "end"), dont_do_tags, ignore_comment, encoding, chunk_size):
+        if event == "start":
+            stack.append(e)
+            continue
+        stack.pop()
+        if len(stack) != depth:
+            continue
+        if stack:
+            stack[-1].kids.remove(e)
+        yield e
+
+
+def parse_bytes(buf, encoding=None, do_strip=None, dont_do_tags=None, ignore_comment=False, chunk_size=1048576,
+                names=None, whitespace=None):
+    """
+    解析 bytes、memoryview 或 mmap。编码没有指定时按 BOM 或 XML 声明判断；
+    一块一块地解码、解析，不会产生整篇文档解码后的副本。
+    """
+    with memoryview(buf) as raw, raw.cast("B") as view:
+        encoding = encoding or _detect_encoding(view[:_max_declaration_size], final=True)
+        decoder = _codecs.getincrementaldecoder(encoding)()
+        parser = _PullParser((), dont_do_tags=dont_do_tags, ignore_comment=ignore_comment, keep_roots=True,
+                             names=names, do_strip=do_strip, whitespace=whitespace)
+        for begin in range(0, len(view), chunk_size):
+            parser.feed(decoder.decode(view[begin:begin + chunk_size]))
+        parser.feed(decoder.decode(b"", final=True))
+        parser.close()
+
+    xml = Xml()
+    xml.kids.extend(parser.roots)
+    return xml
+
+
+def parse_file(path, encoding=None, do_strip=None, dont_do_tags=None, ignore_comment=False, cache_dir=None):
+    """
+    用 mmap 读文件，交给 parse_bytes。
+    指定 cache_dir 时，解析结果以 dump_binary 的格式存在 cache_dir 里；文件的 mtime 和大小没变，
+    或者变了但内容的 SHA-1 相同，下次直接 load_binary，不再解析。
+    """
+    with open(path, "rb") as f:
+        st = _os.fstat(f.fileno())
+        if st.st_size == 0:
+            return parse_bytes(b"", encoding, do_strip, dont_do_tags, ignore_comment)
+        with _mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ) as mm:
+            if cache_dir is None:
+                return parse_bytes(mm, encoding, do_strip, dont_do_tags, ignore_comment)
+            return _parse_cached(path, st, mm, cache_dir, encoding, do_strip, dont_do_tags, ignore_comment)
+
+
+# _pack 产生的扁平列表里，各种节点的头部
+_PACKED_ELEMENT, _PACKED_COMMENT, _PACKED_QM, _PACKED_PROLOG, _PACKED_DOCTYPE = range(5)
+
+
+def _pack(nodes):
+    # 把节点按先序排成一个扁平列表：字符串原样放入，元素放 (类型, tag, attrs, self_closing, 子节点数)，
+    # 子节点紧随其后。同名的 tag、属性名用同一个字符串对象，pickle 只写一次。不递归，多深都能 pickle
+    names = {}
+    packed = []
+    add = packed.append
+    stack = [iter(nodes)]
+    while stack:
+        for node in stack[-1]:
+            if type(node) is str:
+                add(node)
+            elif type(node) is Comment:
+                add((_PACKED_COMMENT, node.text))
+            elif type(node) is DocType:
+                add((_PACKED_DOCTYPE, node.text))
+            elif isinstance(node, QMElement):
+                kind = _PACKED_PROLOG if type(node) is Prolog else _PACKED_QM
+                add((kind, names.setdefault(node.tag, node.tag), dict(node.attrs)))
+            elif isinstance(node, Element):
+                attrs = node._attrs
+                if attrs:
+                    attrs = {names.setdefault(k, k): v for k, v in attrs.items()}
+                kids = _load(node)
+                add((_PACKED_ELEMENT, names.setdefault(node.tag, node.tag), attrs or None, node._self_closing,
+                     len(kids) if kids else 0))
+                if kids:
+                    stack.append(iter(kids))
+                    break
+            else:
+                raise TypeError("Kid type:{} not supported by _pack().".format(type(node)))
+        else:
+            stack.pop()
+    return packed
+
+
+def _unpack(packed):
+    # _pack 的逆操作，返回顶层节点列表
+    roots = []
+    stack = []
+    kids = roots
+    left = -1
+    for item in packed:
+        while left == 0:
+            kids, left = stack.pop()
+        left -= 1
+
+        if type(item) is str:
+            kids.append(item)
+            continue
+        kind = item[0]
+        if kind == _PACKED_ELEMENT:
+            kind, tag, attrs, self_closing, size = item
+            e = _make_element(tag, attrs, self_closing)
+            kids.append(e)
+            if size:
+                stack.append((kids, left))
+                kids = e._kids = []
+                left = size
+        elif kind == _PACKED_COMMENT:
+            kids.append(Comment(item[1]))
+        elif kind == _PACKED_DOCTYPE:
+            kids.append(DocType(item[1]))
+        elif kind == _PACKED_PROLOG:
+            prolog = Prolog()
+            prolog.attrs.clear()
+            prolog.attrs.update(item[2])
+            kids.append(prolog)
+        else:
+            kids.append(QMElement(item[1], item[2]))
+    return roots
+
+
+def _parse_file_packed(path, kwargs):
+    # 在子进程里运行
+    return _pack(parse_file(path, **kwargs).kids)
+
+
+def _xml_from_packed(packed):
+    xml = Xml()
+    xml.kids.extend(_unpack(packed))
+    return xml
+
+
+def parse_many(paths, workers=None, ordered=True, encoding=None, dont_do_tags=None, ignore_comment=False):
+    """
+    用进程池并行解析多个文件，逐个产生 (path, Xml)。
+    ordered 为真时按 paths 的顺序产生，否则谁先解析完先产生谁。
+    子进程把树排成扁平列表（见 _pack）传回，不逐个 pickle Element 对象。
+    workers 为 1 时在本进程里解析。
+    """
+    kwargs = {"encoding": encoding, "dont_do_tags": dont_do_tags, "ignore_comment": ignore_comment}
+    workers = workers or _os.cpu_count() or 1
+    if workers == 1:
+        for path in paths:
+            yield path, parse_file(path, **kwargs)
+        return
+
+    with _futures.ProcessPoolExecutor(workers) as executor:
+        # 同时在跑的任务不超过 workers 的几倍，paths 再多也不会一下子全部提交
+        limit = workers * 4
+        paths = iter(paths)
+        running = _collections.deque()
+        while True:
+            for path in paths:
+                running.append((path, executor.submit(_parse_file_packed, path, kwargs)))
+                if len(running) >= limit:
+                    break
+            if not running:
+                break
+
+            if ordered:
+                path, future = running.popleft()
+            else:
+                done = _futures.wait([f for p, f in running], return_when=_futures.FIRST_COMPLETED).done
+                path, future = next(x for x in running if x[1] in done)
+                running.remove((path, future))
+            yield path, _xml_from_packed(future.result())
+
+
+# 二进制快照：魔数，节点编码的宽度，字符串个数，字符串表的字节数，编码个数，各字符串的长度（字符数），
+# 全部字符串拼接后的 UTF-8，最后是节点编码。长度是小端 uint32，节点编码是按最大值选的 1、2 或 4 字节小端整数。
+# 节点按先序排列，每个节点是一串整数：
+#   字符串 0 s；元素 1 tag 自闭合 子节点数 属性数 名 值 …；注释 2 s；
+#   问号元素 3 tag 属性数 名 值 …；Prolog 4 属性数 名 值 …；DOCTYPE 5 s
+# 其中 s、tag、名、值 都是字符串表里的序号
+_binary_magic = b"XLB1"
+_binary_header = _struct.Struct("<4sBIII")
+_STR, _ELEMENT, _COMMENT, _QM, _PROLOG, _DOCTYPE = range(6)
+
+
+_uint_typecodes = {1: "B", 2: "H", 4: "I" if _array("I").itemsize == 4 else "L"}
+
+
+def _uint_array(width=4, data=b""):
+    codes = _array(_uint_typecodes[width])
+    codes.frombytes(data)
+    if _sys.byteorder == "big":
+        codes.byteswap()
+    return codes
+
+
+def dump_binary(xml, fp):
+    """ 把 Xml 以紧凑的二进制格式写入二进制文件对象 fp，用 load_binary 读回 """
+    table = {}
+    codes = _uint_array()
+    add = codes.append
+
+    def ref(string):
+        try:
+            return table[string]
+        except KeyError:
+            n = table[string] = len(table)
+            return n
+
+    def add_attrs(attrs):
+        add(len(attrs))
+        for key, value in attrs.items():
+            add(ref(key))
+            add(ref(value))
+
+    for item in _pack(xml.kids):
+        if type(item) is str:
+            add(_STR)
+            add(ref(item))
+            continue
+        kind = item[0]
+        if kind == _PACKED_ELEMENT:
+            kind, tag, attrs, self_closing, size = item
+            codes.extend((_ELEMENT, ref(tag), 1 if self_closing else 0, size))
+            add_attrs(attrs or {})
+        elif kind == _PACKED_COMMENT:
+            codes.extend((_COMMENT, ref(item[1])))
+        elif kind == _PACKED_DOCTYPE:
+            codes.extend((_DOCTYPE, ref(item[1])))
+        elif kind == _PACKED_PROLOG:
+            add(_PROLOG)
+            add_attrs(item[2])
+        else:
+            codes.extend((_QM, ref(item[1])))
+            add_attrs(item[2])
+
+    largest = max(codes, default=0)
+    width = 1 if largest < 2 ** 8 else 2 if largest < 2 ** 16 else 4
+    if width != 4:
+        codes = _array(_uint_typecodes[width], codes)
+    lengths = _uint_array()
+    lengths.extend(len(x) for x in table)
+    if _sys.byteorder == "big":
+        lengths.byteswap()
+        codes.byteswap()
+    chars = "".join(table).encode("utf-8", "surrogatepass")
+    fp.write(_binary_header.pack(_binary_magic, width, len(table), len(chars), len(codes)))
+    fp.write(lengths.tobytes())
+    fp.write(chars)
+    fp.write(codes.tobytes())
+
+
+def load_binary(fp):
+    """ 读回 dump_binary 写入的 Xml """
+    header = fp.read(_binary_header.size)
+    if len(header) != _binary_header.size:
+        raise ParseError("Not a binary xl snapshot")
+    magic, width, string_count, chars_size, code_count = _binary_header.unpack(header)
+    if magic != _binary_magic or width not in _uint_typecodes:
+        raise ParseError("Not a binary xl snapshot")
+
+    lengths = fp.read(string_count * 4)
+    chars = fp.read(chars_size)
+    codes = fp.read(code_count * width)
+    if len(lengths) != string_count * 4 or len(chars) != chars_size or len(codes) != code_count * width:
+        raise ParseError("Truncated binary xl snapshot")
+    lengths = _uint_array(4, lengths)
+    try:
+        chars = chars.decode("utf-8", "surrogatepass")
+    except UnicodeDecodeError:
+        raise ParseError("Corrupted binary xl snapshot")
+    if sum(lengths) != len(chars):
+        raise ParseError("Corrupted binary xl snapshot")
+
+    strings = []
+    begin = 0
+    for length in lengths:
+        strings.append(chars[begin:begin + length])
+        begin += length
+
+    try:
+        kids = _load_codes(_uint_array(width, codes).tolist(), strings)
+    except (IndexError, ValueError):
+        raise ParseError("Corrupted binary xl snapshot")
+    xml = Xml()
+    xml.kids.extend(kids)
+    return xml
+
+
+def _load_codes(codes, strings):
+    roots = []
+    stack = []
+    push = stack.append
+    pop = stack.pop
+    kids = roots
+    add = kids.append
+    left = -1
+    make_element = _make_element
+    i = 0
+    length = len(codes)
+    while i < length:
+        while left == 0:
+            kids, left = pop()
+            add = kids.append
+        left -= 1
+
+        op = codes[i]
+        if op == _ELEMENT:
+            tag, self_closing, size, attr_count = codes[i + 1:i + 5]
+            i += 5
+            if attr_count:
+                end = i + 2 * attr_count
+                attrs = {strings[codes[j]]: strings[codes[j + 1]] for j in range(i, end, 2)}
+                i = end
+            else:
+                attrs = None
+            e = make_element(strings[tag], attrs, self_closing == 1)
+            add(e)
+            if size:
+                push((kids, left))
+                kids = e._kids = []
+                add = kids.append
+                left = size
+        elif op == _STR:
+            add(strings[codes[i + 1]])
+            i += 2
+        elif op == _COMMENT:
+            add(Comment(strings[codes[i + 1]]))
+            i += 2
+        elif op == _DOCTYPE:
+            add(DocType(strings[codes[i + 1]]))
+            i += 2
+        elif op == _QM or op == _PROLOG:
+            if op == _QM:
+                e = QMElement(strings[codes[i + 1]])
+                i += 2
+            else:
+                e = Prolog()
+                e.attrs.clear()
+                i += 1
+            end = i + 1 + 2 * codes[i]
+            e.attrs.update((strings[codes[j]], strings[codes[j + 1]]) for j in range(i + 1, end, 2))
+            i = end
+            add(e)
+        else:
+            raise ValueError(op)
+    while left == 0 and stack:
+        kids, left = pop()
+    if stack or left > 0:
+        raise ValueError("truncated")
+    return roots
+
+
+_cache_header = _struct.Struct("<4sqq20s")
+_cache_magic = b"XLC1"
+
+
+def _parse_cached(path, st, data, cache_dir, encoding, do_strip, dont_do_tags, ignore_comment):
+    # 缓存文件：_cache_header（魔数、源文件的 mtime_ns、大小、SHA-1）之后是 dump_binary 的内容
+    key = repr((_os.path.abspath(path), encoding, do_strip is False, sorted(dont_do_tags or []), bool(ignore_comment),
+                __version__))
+    cache_path = _os.path.join(cache_dir, _hashlib.sha1(key.encode("utf-8", "surrogatepass")).hexdigest() + ".xlb")
+
+    digest = None
+    try:
+        with open(cache_path, "rb") as f:
+            magic, mtime_ns, size, cached_digest = _cache_header.unpack(f.read(_cache_header.size))
+            if magic == _cache_magic and size == st.st_size:
+                if mtime_ns == st.st_mtime_ns:
+                    return load_binary(f)
+                digest = _hashlib.sha1(data).digest()
+                if digest == cached_digest:
+                    xml = load_binary(f)
+                    _write_cache(cache_path, st, digest, xml)
+                    return xml
+    except (OSError, _struct.error, ParseError):
+        pass
+
+    xml = parse_bytes(data, encoding, do_strip, dont_do_tags, ignore_comment)
+    _write_cache(cache_path, st, digest or _hashlib.sha1(data).digest(), xml)
+    return xml
+
+
+def _write_cache(cache_path, st, digest, xml):
+    # 先写临时文件再改名，别的进程不会读到写了一半的缓存
+    _os.makedirs(_os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(cache_path, _os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(_cache_header.pack(_cache_magic, st.st_mtime_ns, st.st_size, digest))
+        dump_binary(xml, f)
+    _os.replace(tmp_path, cache_path)
+
+
+class ParseCache(object):
+    """
+    parse 的结果缓存，按文本的 SHA-1 和解析选项查找，最近最少使用的先淘汰。
+    缓存里存的是 dump_binary 的快照，每次命中都读回一棵新树，调用者之间互不影响。
+    max_entries 限制条数，max_size 限制快照的总字节数。
+    """
+    def __init__(self, max_entries=128, max_size=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = _collections.OrderedDict()
+        self._lock = _threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def parse(self, text, do_strip=None, dont_do_tags=None, ignore_comment=False, index=False):
+        key = (_hashlib.sha1(text.encode("utf-8", "surrogatepass")).digest(), len(text),
+               do_strip is False, tuple(sorted(dont_do_tags or [])), bool(ignore_comment))
+        with self._lock:
+            snapshot = self._entries.get(key)
+            if snapshot is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if snapshot is None:
+            xml = parse(text, do_strip, dont_do_tags, ignore_comment)
+            bio = _io.BytesIO()
+            dump_binary(xml, bio)
+            self._add(key, bio.getvalue())
+        else:
+            xml = load_binary(_io.BytesIO(snapshot))
+
+        if index:
+            xml.build_index()
+        return xml
+
+    def _add(self, key, snapshot):
+        if len(snapshot) > self.max_size:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = snapshot
+            self.size += len(snapshot)
+            while len(self._entries) > self.max_entries or self.size > self.max_size:
+                key, old = self._entries.popitem(last=False)
+                self.size -= len(old)